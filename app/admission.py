@@ -0,0 +1,138 @@
+"""
+Admission control
+
+Requests are sorted by path into route groups, e.g. the bcrypt bound auth
+routes, and a group runs ADMISSION_GROUPS limit requests at once. Others
+wait in line for queue_ms at most, then they are answered 503 with a
+Retry-After header at once, instead of all taking threads of the shared pool
+until every route times out behind the slow ones.
+
+Paths of no group, e.g. the cached daily reads, are never held back.
+"""
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Iterator, Optional, Tuple, Any
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Scope, Receive, Send
+
+from app.config import settings
+from app.metrics import COLLECTORS, inc
+
+
+class Limiter:
+    """at most limit holders, the others wait in line queue_timeout seconds"""
+
+    def __init__(self, limit: int, queue_timeout: float):
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> bool:
+        """take a slot, False if none was free within queue_timeout"""
+        if self.running < self.limit and not self._waiters:
+            self.running += 1
+            return True
+        if self.queue_timeout <= 0:
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # handed the slot just as the wait timed out
+                return True
+            waiter.cancel()
+            return False
+        except asyncio.CancelledError:
+            # the client went away, give back a slot handed meanwhile
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            waiter.cancel()
+            raise
+        finally:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+
+    def release(self) -> None:
+        # the slot passes to the first in line
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
+
+
+def match_route(routes: Dict[str, Any], path: str) -> Optional[Any]:
+    """value of the longest path prefix of routes, prefixes are after API_V1_STR"""
+    if not path.startswith(settings.API_V1_STR):
+        return None
+    path = path[len(settings.API_V1_STR):].rstrip("/")
+    while path:
+        value = routes.get(path)
+        if value is not None:
+            return value
+        path = path.rpartition("/")[0]
+    return None
+
+
+def route_group(path: str) -> Optional[str]:
+    """group of the longest ADMISSION_ROUTES prefix of path, None if no group"""
+    return match_route(settings.ADMISSION_ROUTES, path) or None
+
+
+# limiters of the route groups, shared by the app of this process
+limiters: Dict[str, Limiter] = {
+    group: Limiter(int(options["limit"]), options.get("queue_ms", 0) / 1000)
+    for group, options in settings.ADMISSION_GROUPS.items()
+}
+
+
+def admission_gauges() -> Iterator[Tuple[str, Dict[str, Any], float]]:
+    for group, limiter in limiters.items():
+        yield "admission_requests", {"group": group, "state": "running"}, limiter.running
+        yield "admission_requests", {"group": group, "state": "queued"}, limiter.queued
+
+
+COLLECTORS.append(admission_gauges)
+
+
+class AdmissionMiddleware:
+    """hold the requests of a route group over its limit, shed them past their deadline"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        limiter = None
+        if scope["type"] == "http":
+            group = route_group(scope["path"])
+            limiter = limiters.get(group) if group else None
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await limiter.acquire():
+            inc("http_requests_shed_total", group=group)
+            response = JSONResponse(
+                {"detail": "Server busy, retry later"},
+                status_code=503,
+                headers={"Retry-After": str(settings.ADMISSION_RETRY_AFTER)},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
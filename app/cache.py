@@ -0,0 +1,490 @@
+"""
+In-process cache
+
+CACHE_BACKEND=memory replaces the redis clients with a store in this
+process, for single node deployments and tests with no redis server. It
+answers the redis commands of the api the way redis does: strings, hashes,
+sets and bitmaps with expiry, pipelines and locks, values returned as bytes.
+
+The store is of one process, so the api runs a single worker with it,
+several would each have their own daily rows, counters and id pools. The
+email outbox needs a redis shared with the email worker: its queue commands
+raise a RedisError here, so the api sends emails in background of the
+request as it does while redis is down.
+"""
+import asyncio
+import fnmatch
+import math
+import random
+import threading
+import time
+import uuid
+from datetime import timedelta
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from redis.exceptions import (
+    DataError, LockError, LockNotOwnedError, RedisError, ResponseError,
+)
+
+EncodableT = Union[bytes, str, int, float]
+ExpiryT = Union[int, timedelta]
+
+WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+PURGE_INTERVAL = 60  # seconds between sweeps of the expired keys
+
+
+class UnsupportedCommand(RedisError):
+    """a redis command the memory cache doesn't answer"""
+
+
+def _encode(value: EncodableT) -> bytes:
+    # as redis-py encodes command arguments
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    if isinstance(value, bool):
+        raise DataError("invalid input of type bool")
+    if isinstance(value, int):
+        return str(value).encode("utf-8")
+    if isinstance(value, float):
+        return repr(value).encode("utf-8")
+    raise DataError(f"invalid input of type {type(value).__name__}")
+
+
+def _seconds(time_: ExpiryT) -> float:
+    return time_.total_seconds() if isinstance(time_, timedelta) else time_
+
+
+class MemoryRedis:
+    """the redis commands of the api on dicts of this process"""
+
+    def __init__(self):
+        self._data: Dict[bytes, Any] = {}
+        self._expires: Dict[bytes, float] = {}
+        self._mutex = threading.RLock()
+        self._purged = time.monotonic()
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def unsupported(*args, **kwargs):
+            raise UnsupportedCommand(f"{name} is not supported by the memory cache")
+
+        return unsupported
+
+    # keys
+
+    def _get(self, name: EncodableT, kind: type = None) -> Any:
+        key = _encode(name)
+        expire_at = self._expires.get(key)
+        if expire_at is not None and expire_at <= time.monotonic():
+            self._remove(key)
+            return None
+        value = self._data.get(key)
+        if value is not None and kind is not None and not isinstance(value, kind):
+            raise ResponseError(WRONGTYPE)
+        return value
+
+    def _remove(self, key: bytes) -> bool:
+        self._expires.pop(key, None)
+        return self._data.pop(key, None) is not None
+
+    def _purge(self) -> None:
+        # expired keys nobody reads again
+        now = time.monotonic()
+        if now - self._purged < PURGE_INTERVAL:
+            return
+        self._purged = now
+        for key in [key for key, expire_at in self._expires.items() if expire_at <= now]:
+            self._remove(key)
+
+    def delete(self, *names: EncodableT) -> int:
+        with self._mutex:
+            return sum(
+                self._get(name) is not None and self._remove(_encode(name)) for name in names
+            )
+
+    def exists(self, *names: EncodableT) -> int:
+        with self._mutex:
+            return sum(self._get(name) is not None for name in names)
+
+    def expire(self, name: EncodableT, time_: ExpiryT) -> bool:
+        with self._mutex:
+            self._purge()
+            if self._get(name) is None:
+                return False
+            self._expires[_encode(name)] = time.monotonic() + _seconds(time_)
+            return True
+
+    def ttl(self, name: EncodableT) -> int:
+        with self._mutex:
+            if self._get(name) is None:
+                return -2
+            expire_at = self._expires.get(_encode(name))
+            if expire_at is None:
+                return -1
+            return round(expire_at - time.monotonic())
+
+    def scan_iter(
+        self, match: Optional[str] = None, count: Optional[int] = None
+    ) -> Iterator[bytes]:
+        with self._mutex:
+            keys = [key for key in list(self._data) if self._get(key) is not None]
+        pattern = match.encode("utf-8") if isinstance(match, str) else match
+        for key in keys:
+            if pattern is None or fnmatch.fnmatchcase(key, pattern):
+                yield key
+
+    def flushdb(self) -> bool:
+        with self._mutex:
+            self._data.clear()
+            self._expires.clear()
+        return True
+
+    # strings
+
+    def get(self, name: EncodableT) -> Optional[bytes]:
+        with self._mutex:
+            value = self._get(name, bytearray)
+            return bytes(value) if value is not None else None
+
+    def set(
+        self,
+        name: EncodableT,
+        value: EncodableT,
+        ex: Optional[ExpiryT] = None,
+        px: Optional[ExpiryT] = None,
+        nx: bool = False,
+    ) -> Optional[bool]:
+        with self._mutex:
+            self._purge()
+            if nx and self._get(name) is not None:
+                return None
+            key = _encode(name)
+            self._remove(key)
+            self._data[key] = bytearray(_encode(value))
+            if ex is not None:
+                self._expires[key] = time.monotonic() + _seconds(ex)
+            elif px is not None:
+                self._expires[key] = time.monotonic() + _seconds(px) / 1000
+            return True
+
+    def setbit(self, name: EncodableT, offset: int, value: int) -> int:
+        with self._mutex:
+            bits = self._get(name, bytearray)
+            if bits is None:
+                bits = self._data[_encode(name)] = bytearray()
+            index, mask = offset // 8, 1 << (7 - offset % 8)
+            if index >= len(bits):
+                bits.extend(bytes(index + 1 - len(bits)))
+            old = int(bool(bits[index] & mask))
+            if value:
+                bits[index] |= mask
+            else:
+                bits[index] &= ~mask
+            return old
+
+    def getbit(self, name: EncodableT, offset: int) -> int:
+        with self._mutex:
+            bits = self._get(name, bytearray)
+            index = offset // 8
+            if bits is None or index >= len(bits):
+                return 0
+            return int(bool(bits[index] & 1 << (7 - offset % 8)))
+
+    # hashes
+
+    def hget(self, name: EncodableT, key: EncodableT) -> Optional[bytes]:
+        with self._mutex:
+            return (self._get(name, dict) or {}).get(_encode(key))
+
+    def hgetall(self, name: EncodableT) -> Dict[bytes, bytes]:
+        with self._mutex:
+            return dict(self._get(name, dict) or {})
+
+    def hset(
+        self,
+        name: EncodableT,
+        key: Optional[EncodableT] = None,
+        value: Optional[EncodableT] = None,
+        mapping: Optional[Dict[EncodableT, EncodableT]] = None,
+    ) -> int:
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        if not items:
+            raise DataError("'hset' with no key value pairs")
+        with self._mutex:
+            fields = self._get(name, dict)
+            if fields is None:
+                fields = self._data[_encode(name)] = {}
+            added = 0
+            for field, field_value in items.items():
+                field = _encode(field)
+                added += field not in fields
+                fields[field] = _encode(field_value)
+            return added
+
+    def hdel(self, name: EncodableT, *keys: EncodableT) -> int:
+        with self._mutex:
+            fields = self._get(name, dict)
+            if fields is None:
+                return 0
+            removed = 0
+            for key in keys:
+                removed += fields.pop(_encode(key), None) is not None
+            if not fields:
+                self._remove(_encode(name))
+            return removed
+
+    def hincrby(self, name: EncodableT, key: EncodableT, amount: int = 1) -> int:
+        with self._mutex:
+            fields = self._get(name, dict)
+            if fields is None:
+                fields = self._data[_encode(name)] = {}
+            field = _encode(key)
+            try:
+                value = int(fields.get(field, b"0")) + amount
+            except ValueError:
+                raise ResponseError("ERR hash value is not an integer")
+            fields[field] = _encode(value)
+            return value
+
+    # sets
+
+    def sadd(self, name: EncodableT, *values: EncodableT) -> int:
+        with self._mutex:
+            members = self._get(name, set)
+            if members is None:
+                members = self._data[_encode(name)] = set()
+            size = len(members)
+            members.update(_encode(value) for value in values)
+            return len(members) - size
+
+    def srem(self, name: EncodableT, *values: EncodableT) -> int:
+        with self._mutex:
+            members = self._get(name, set)
+            if members is None:
+                return 0
+            size = len(members)
+            members.difference_update(_encode(value) for value in values)
+            if not members:
+                self._remove(_encode(name))
+            return size - len(members)
+
+    def smembers(self, name: EncodableT) -> Set[bytes]:
+        with self._mutex:
+            return set(self._get(name, set) or ())
+
+    def scard(self, name: EncodableT) -> int:
+        with self._mutex:
+            return len(self._get(name, set) or ())
+
+    def srandmember(
+        self, name: EncodableT, number: Optional[int] = None
+    ) -> Union[Optional[bytes], List[bytes]]:
+        with self._mutex:
+            members = list(self._get(name, set) or ())
+        if number is None:
+            return random.choice(members) if members else None
+        if number < 0:
+            # repeated members, as redis does for a negative count
+            return random.choices(members, k=-number) if members else []
+        return random.sample(members, min(number, len(members)))
+
+    # pipelines and locks
+
+    def pipeline(self, transaction: bool = True, shard_hint: Any = None) -> "MemoryPipeline":
+        return MemoryPipeline(self)
+
+    def lock(
+        self,
+        name: str,
+        timeout: Optional[float] = None,
+        sleep: float = 0.1,
+        blocking: bool = True,
+        blocking_timeout: Optional[float] = None,
+    ) -> "MemoryLock":
+        return MemoryLock(self, name, timeout, sleep, blocking, blocking_timeout)
+
+
+class MemoryPipeline:
+    """commands buffered and run at once, none other runs in between"""
+
+    def __init__(self, cache: MemoryRedis):
+        self.cache = cache
+        self.commands: List[Tuple[str, tuple, dict]] = []
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def buffer(*args, **kwargs) -> "MemoryPipeline":
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return buffer
+
+    def __len__(self) -> int:
+        return len(self.commands)
+
+    def __enter__(self) -> "MemoryPipeline":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.commands = []
+
+    def execute(self, raise_on_error: bool = True) -> List[Any]:
+        results = []
+        with self.cache._mutex:
+            for name, args, kwargs in self.commands:
+                try:
+                    results.append(getattr(self.cache, name)(*args, **kwargs))
+                except RedisError as e:
+                    results.append(e)
+        self.reset()
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, RedisError):
+                    raise result
+        return results
+
+
+class MemoryLock:
+    """a lock key set if not set, as the redis lock"""
+
+    def __init__(
+        self,
+        cache: MemoryRedis,
+        name: str,
+        timeout: Optional[float] = None,
+        sleep: float = 0.1,
+        blocking: bool = True,
+        blocking_timeout: Optional[float] = None,
+    ):
+        self.cache = cache
+        self.name = name
+        self.timeout = timeout
+        self.sleep = sleep
+        self.blocking = blocking
+        self.blocking_timeout = blocking_timeout
+        self.token: Optional[bytes] = None
+
+    def __enter__(self) -> "MemoryLock":
+        if self.acquire():
+            return self
+        raise LockError("Unable to acquire lock within the time specified")
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+    def _try(self, token: bytes) -> bool:
+        px = math.ceil(self.timeout * 1000) if self.timeout else None
+        return bool(self.cache.set(self.name, token, px=px, nx=True))
+
+    def _deadline(self, blocking_timeout: Optional[float]) -> Optional[float]:
+        if blocking_timeout is None:
+            blocking_timeout = self.blocking_timeout
+        return time.monotonic() + blocking_timeout if blocking_timeout is not None else None
+
+    def acquire(
+        self, blocking: Optional[bool] = None, blocking_timeout: Optional[float] = None
+    ) -> bool:
+        token = uuid.uuid4().hex.encode("utf-8")
+        blocking = self.blocking if blocking is None else blocking
+        deadline = self._deadline(blocking_timeout)
+        while True:
+            if self._try(token):
+                self.token = token
+                return True
+            if not blocking or deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.sleep)
+
+    def release(self) -> None:
+        token, self.token = self.token, None
+        if token is None:
+            raise LockError("Cannot release an unlocked lock")
+        with self.cache._mutex:
+            if self.cache.get(self.name) != token:
+                raise LockNotOwnedError("Cannot release a lock that's no longer owned")
+            self.cache.delete(self.name)
+
+
+class AsyncMemoryRedis:
+    """the memory cache with the interface of the asyncio redis client"""
+
+    def __init__(self, cache: MemoryRedis):
+        self.cache = cache
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        command = getattr(self.cache, name)
+
+        async def call(*args, **kwargs):
+            return command(*args, **kwargs)
+
+        return call
+
+    async def scan_iter(self, match: Optional[str] = None, count: Optional[int] = None):
+        for key in self.cache.scan_iter(match=match, count=count):
+            yield key
+
+    def pipeline(
+        self, transaction: bool = True, shard_hint: Any = None
+    ) -> "AsyncMemoryPipeline":
+        return AsyncMemoryPipeline(self.cache)
+
+    def lock(
+        self,
+        name: str,
+        timeout: Optional[float] = None,
+        sleep: float = 0.1,
+        blocking: bool = True,
+        blocking_timeout: Optional[float] = None,
+    ) -> "AsyncMemoryLock":
+        return AsyncMemoryLock(self.cache, name, timeout, sleep, blocking, blocking_timeout)
+
+
+class AsyncMemoryPipeline(MemoryPipeline):
+    async def __aenter__(self) -> "AsyncMemoryPipeline":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.reset()
+
+    async def execute(self, raise_on_error: bool = True) -> List[Any]:
+        return super().execute(raise_on_error)
+
+
+class AsyncMemoryLock(MemoryLock):
+    async def __aenter__(self) -> "AsyncMemoryLock":
+        if await self.acquire():
+            return self
+        raise LockError("Unable to acquire lock within the time specified")
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.release()
+
+    async def acquire(
+        self, blocking: Optional[bool] = None, blocking_timeout: Optional[float] = None
+    ) -> bool:
+        token = uuid.uuid4().hex.encode("utf-8")
+        blocking = self.blocking if blocking is None else blocking
+        deadline = self._deadline(blocking_timeout)
+        while True:
+            if self._try(token):
+                self.token = token
+                return True
+            if not blocking or deadline is not None and time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(self.sleep)
+
+    async def release(self) -> None:
+        super().release()
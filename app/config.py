@@ -1,4 +1,4 @@
-from typing import Optional, Any, Dict
+from typing import Optional, Any, Dict, List
 
 from pydantic import BaseSettings, EmailStr, validator
 
@@ -14,10 +14,111 @@ class Settings(BaseSettings):
     USERS_OPEN_REGISTRATION: bool = False  # whether open user register
     DATABASE_URI: str = "sqlite:///./app.db"  # database url
 
+    # read replicas of the database, read only requests read from them
+    DATABASE_REPLICA_URIS: List[str] = []
+    REPLICA_RETRY_INTERVAL: int = 10  # seconds a failing replica is skipped
+    REPLICA_STICKY_SECONDS: int = 5  # a client reads from the primary after it wrote
+
+    # db pool, of postgres, mysql and sqlite files
+    DB_POOL_SIZE: int = 5  # connections kept open
+    DB_MAX_OVERFLOW: int = 10  # connections opened over pool size under load
+    DB_POOL_TIMEOUT: int = 30  # seconds waiting for a free connection
+    DB_POOL_RECYCLE: int = 30 * 60  # connections reopened after seconds
+    DB_POOL_PRE_PING: bool = True  # test a connection before using it
+    DB_QUERY_CACHE_SIZE: int = 500  # compiled statements cached by the engine
+
+    # sqlite pragmas of every connection
+    SQLITE_JOURNAL_MODE: str = "WAL"  # readers don't block the writer
+    SQLITE_SYNCHRONOUS: str = "NORMAL"  # safe with WAL, fsync on checkpoint only
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024  # bytes of the db file memory mapped
+    SQLITE_CACHE_SIZE: int = -64 * 1024  # page cache, negative is in KiB
+    SQLITE_BUSY_TIMEOUT: int = 5000  # ms waiting for a lock before failing
+
+    METRICS_ENABLED: bool = True  # request metrics exported at /metrics
+
+    # sampling profiler
+    PROFILE_INTERVAL_MS: int = 5  # stacks sampled every ms
+    PROFILE_MAX_SECONDS: int = 60  # longest profile of /utils/profile
+    PROFILE_EXPIRE: int = 60 * 60  # profiles of X-Profile requests kept for seconds
+
+    # group commit of concurrent creates
+    WRITE_BATCH_ENABLED: bool = False  # creates within the window share one transaction
+    WRITE_BATCH_WINDOW_MS: int = 5  # ms the first create of a batch waits for others
+    WRITE_BATCH_MAX_SIZE: int = 100  # rows committed at most in a batch
+
+    # admission control, a route group runs limit requests at once, the others
+    # wait in line queue_ms at most and are answered 503
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_GROUPS: Dict[str, Dict[str, float]] = {
+        "auth": {"limit": 4, "queue_ms": 2000},
+        "content": {"limit": 32, "queue_ms": 1000},
+    }
+    # route group of a path prefix after API_V1_STR, the longest prefix wins,
+    # an empty group is never held back, e.g. the cached daily reads
+    ADMISSION_ROUTES: Dict[str, str] = {
+        "/login": "auth",
+        "/register": "auth",
+        "/me/reset-password": "auth",
+        "/me/confirm-password": "auth",
+        "/psychologies": "content",
+        "/psychologies/daily": "",
+        "/words": "content",
+        "/words/daily": "",
+        "/users": "content",
+    }
+    ADMISSION_RETRY_AFTER: int = 1  # seconds in Retry-After of a 503
+
+    # rate limits of routes, requests in seconds per user or client ip,
+    # a quota left out is unlimited
+    RATE_LIMITS: Dict[str, Dict[str, float]] = {
+        "login": {"requests": 10, "seconds": 60},
+        "random": {"requests": 120, "seconds": 60},
+    }
+    RATE_LIMIT_LEASE: int = 10  # tokens a worker takes from redis at once
+    RATE_LIMIT_LEASE_SECONDS: float = 1  # leased tokens unspent after are dropped
+
+    # request deadlines, statements past them are cancelled and answered 504
+    REQUEST_TIMEOUT: float = 30  # seconds of a request, 0 none
+    # seconds of the requests of a path prefix after API_V1_STR, the longest wins
+    REQUEST_TIMEOUTS: Dict[str, float] = {
+        "/psychologies": 10,
+        "/psychologies/random": 5,
+        "/words": 10,
+        "/users": 10,
+    }
+
+    # sql queries
+    SQL_QUERY_HEADERS: bool = False  # responses carry sql query count and time
+    SQL_SLOW_QUERY_MS: int = 200  # queries slower than it are logged
+    SQL_REPEAT_THRESHOLD: int = 10  # a statement issued this times in a request is warned
+
+    # production server, `manage.py run --prod`
+    WORKERS: int = 0  # worker processes, 0 is the cpu count
+    KEEP_ALIVE: int = 5  # seconds an idle keep-alive connection is kept
+    BACKLOG: int = 2048  # pending connections queued by the socket
+    GRACEFUL_TIMEOUT: int = 30  # seconds a restarted worker finishes its requests
+    MAX_REQUESTS: int = 0  # worker restarted after requests, 0 never
+
     # redis
+    CACHE_BACKEND: str = "redis"  # redis, or memory: no redis server, a single worker
     REDIS_HOST: str = "127.0.0.1"
     REDIS_PORT: int = 6379
     REDIS_DB: str = "0"
+    REDIS_SOCKET_TIMEOUT: float = 2  # seconds, over the 1s blocking pops of the workers
+    REDIS_CONNECT_TIMEOUT: float = 0.5  # seconds
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30  # idle connections pinged before use
+    REDIS_BREAKER_FAILURES: int = 5  # connection errors in a row opening the circuit
+    REDIS_BREAKER_RESET: float = 10  # seconds the open circuit fails fast
+
+    # list counters expire after 1 hour and are exactly recounted on next read
+    COUNT_RECOUNT_EXPIRE: int = 60 * 60
+    # random id pools expire after 1 hour and are reloaded on next read
+    ID_POOL_EXPIRE: int = 60 * 60
+    # seen ids of a user expire after 30 days
+    SEEN_EXPIRE: int = 60 * 60 * 24 * 30
+
+    # weights of psychology classify for weighted random, default 1
+    PSYCHOLOGY_CLASSIFY_WEIGHTS: Dict[str, float] = {}
 
     # token expire time
     # 60 minutes * 24 hours * 8 days = 8 days
@@ -36,9 +137,25 @@ class Settings(BaseSettings):
     EMAILS_FROM_EMAIL: Optional[EmailStr] = "soulapi@shiniao.fun"  # email from
 
     EMAIL_TEMPLATES_DIR: str = "email-templates"  # email templates dir
+    EMAIL_TEMPLATES_RELOAD: bool = False  # reload changed email templates, for dev
 
     EMAILS_ENABLED: bool = True  # if email enabled
 
+    # email worker
+    EMAILS_WORKER_CONCURRENCY: int = 4  # emails sent at the same time
+    EMAILS_MAX_ATTEMPTS: int = 5  # failed email dropped after attempts
+    EMAILS_RETRY_BACKOFF: int = 10  # first retry after seconds, then doubled
+
+    # daily digest
+    DIGEST_BATCH_SIZE: int = 1000  # users read from db at a time
+    DIGEST_CONCURRENCY: int = 4  # digests sent at the same time
+    DIGEST_RATE_LIMIT: float = 50  # digests sent per second at most, 0 unlimited
+
+    # lunar table, built by `manage.py lunar build`
+    LUNAR_TABLE_PATH: str = "lunar.dat"  # lunar table file in app dir
+    LUNAR_TABLE_START: int = 1900  # first year in lunar table
+    LUNAR_TABLE_END: int = 2100  # last year in lunar table
+
     # superuser
     SUPERUSER_NAME: str = "admin"
     SUPERUSER_EMAIL: str = "admin@example.com"
@@ -52,6 +169,27 @@ class Settings(BaseSettings):
             and values.get("EMAILS_FROM_EMAIL")
         )
 
+    @validator("CACHE_BACKEND")
+    def check_cache_backend(cls, v: str) -> str:
+        if v not in ("redis", "memory"):
+            raise ValueError(f"unknown cache backend {v}, redis or memory")
+        return v
+
+    @validator("PSYCHOLOGY_CLASSIFY_WEIGHTS")
+    def check_classify_weights(cls, v: Dict[str, float]) -> Dict[str, float]:
+        from app.schemas.psychology import PsychologyClassifyEnum
+
+        classifies = {classify.value for classify in PsychologyClassifyEnum}
+        unknown = sorted(set(v) - classifies)
+        if unknown:
+            raise ValueError(f"unknown psychology classify {', '.join(unknown)}")
+        if any(weight < 0 for weight in v.values()):
+            raise ValueError("psychology classify weights can't be negative")
+        # classifies left out weigh 1
+        if not any({**dict.fromkeys(classifies, 1), **v}.values()):
+            raise ValueError("at least one psychology classify weight must be positive")
+        return v
+
     @validator("EMAILS_FROM_NAME")
     def get_project_name(cls, v: Optional[str], values: Dict[str, Any]) -> str:
         if not v:
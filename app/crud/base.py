@@ -1,38 +1,77 @@
-from typing import Generic, TypeVar, Type, Any, Optional, List, Union, Dict
+import json
+import random
+from datetime import datetime
+from typing import Generic, TypeVar, Type, Any, Optional, List, Union, Dict, Tuple, Callable
 
 from fastapi.encoders import jsonable_encoder
+from loguru import logger
 from pydantic import BaseModel
+from redis import Redis, RedisError
+from redis.asyncio import Redis as AsyncRedis
+from sqlalchemy import func
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
-from app.database import Base
+from app.config import settings
+from app.database import Base, RedisLocal
+from app.metrics import timer
 
 ModelType = TypeVar("ModelType", bound=Base)
 CreateSchemaType = TypeVar("CreateSchemaType", bound=BaseModel)
 UpdateSchemaType = TypeVar("UpdateSchemaType", bound=BaseModel)
 
+# key: (date, id) of the rows of the day while redis is down
+_local_daily: Dict[str, Tuple[str, int]] = {}
+# seconds a worker picking the row of the day holds its lock, and others wait for it
+DAILY_LOCK_TIMEOUT = 5
+
 
 class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
+    # fields which keep a row counter and a random id pool per value
+    # besides the ones of the whole table
+    group_fields: Tuple[str, ...] = ()
+
     def __init__(self, model: Type[ModelType]):
         """crud base class"""
         self.model = model
+        self.count_key = f"{model.__tablename__}_count"
 
     def get(self, db: Session, id: Any) -> Optional[ModelType]:
         return db.query(self.model).filter(self.model.id == id).first()
 
     def get_multi(
-            self, db: Session, *, skip: int = 0, limit: int = 10
+            self, db: Session, *, skip: int = 0, limit: int = 10, **filters
     ) -> List[ModelType]:
-        return db.query(self.model).offset(skip).limit(limit).all()
+        return (
+            db.query(self.model)
+            .filter_by(**_group_filters(filters))
+            .offset(skip)
+            .limit(limit)
+            .all()
+        )
 
     def create(self, db: Session, *, obj: CreateSchemaType) -> ModelType:
         # db compatible with json
         obj_data = jsonable_encoder(obj)
-        db_obj = self.model(**obj_data)
-        db.add(db_obj)
-        db.commit()
-        db.refresh(db_obj)
+        if settings.WRITE_BATCH_ENABLED:
+            db_obj = self._create_batched(db, obj_data)
+        else:
+            db_obj = self.model(**obj_data)
+            db.add(db_obj)
+            db.commit()
+            db.refresh(db_obj)
+        self.cache_row(db_obj)
         return db_obj
 
+    def _create_batched(self, db: Session, obj_data: Dict[str, Any]) -> ModelType:
+        from app.crud.batch import write_batcher
+
+        id = write_batcher.insert(self.model, obj_data)
+        # committed by the batch, the session only reads it back from the primary
+        db.wrote = True
+        db.commit()
+        return self.get(db, id=id)
+
     def update(
             self,
             db: Session,
@@ -56,6 +95,9 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
             # if pydantic model, convert to dict
             update_data = obj.dict(exclude_unset=True)
 
+        # group values before update, to move the row if they change
+        groups = self._groups(db_obj)
+
         # if need updated field in db_obj, update it
         for field in obj_data:
             if field in update_data:
@@ -64,10 +106,532 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         db.add(db_obj)
         db.commit()
         db.refresh(db_obj)
+
+        if groups != self._groups(db_obj):
+            self.cache_row(db_obj, -1, groups=groups)
+            self.cache_row(db_obj)
+        self.forget_daily_rows()
         return db_obj
 
     def remove(self, db: Session, *, id: int) -> ModelType:
         obj = db.query(self.model).get(id)
         db.delete(obj)
         db.commit()
+        self.cache_row(obj, -1)
+        self.forget_daily_rows()
         return obj
+
+    # daily
+
+    def get_daily(
+        self, db: Session, redis: Redis, key: str, pick: Callable[[], Optional[ModelType]]
+    ) -> Optional[ModelType]:
+        """
+        the row of the day, picked once a day and its id kept in redis hash key,
+        kept in this process while redis is down
+        :param pick: pick a new row of the day
+        """
+        today = datetime.strftime(datetime.now(), "%Y%m%d")
+        try:
+            with timer("dependency_duration_seconds", dependency="redis"):
+                redis_data = redis.hgetall(key)
+        except RedisError as e:
+            logger.warning(f"read {key} failed, use local daily: {e}")
+            return self._get_daily_local(db, key, today, pick)
+
+        # only time equal current day read from redis
+        if _is_today(redis_data, today):
+            return self.get(db, id=redis_data.get(b"id").decode("utf-8"))
+
+        # if time not today, pick a new one and save to redis cache,
+        # one worker picks it while the others wait for it
+        lock = redis.lock(
+            f"{key}:lock", timeout=DAILY_LOCK_TIMEOUT, blocking_timeout=DAILY_LOCK_TIMEOUT
+        )
+        acquired = False
+        try:
+            acquired = lock.acquire()
+            # picked by another worker meanwhile, or while we timed out waiting
+            redis_data = redis.hgetall(key)
+        except RedisError as e:
+            self._release_daily_lock(lock, acquired)
+            logger.warning(f"read {key} failed, use local daily: {e}")
+            return self._get_daily_local(db, key, today, pick)
+        if _is_today(redis_data, today):
+            self._release_daily_lock(lock, acquired)
+            return self.get(db, id=redis_data.get(b"id").decode("utf-8"))
+        if not acquired:
+            logger.warning(f"wait for {key} timed out, use local daily")
+            return self._get_daily_local(db, key, today, pick)
+
+        db_obj = None
+        try:
+            db_obj = pick()
+            if db_obj:
+                # the row of the async path is the one of the day too
+                redis.hset(
+                    key,
+                    mapping={"id": db_obj.id, "date": today, "row": _dumps_row(db_obj)},
+                )
+        except RedisError as e:
+            logger.warning(f"save {key} failed: {e}")
+        finally:
+            self._release_daily_lock(lock, acquired)
+        return db_obj
+
+    async def get_daily_async(
+        self,
+        db: Session,
+        redis: AsyncRedis,
+        key: str,
+        pick: Callable[[], Optional[ModelType]],
+    ) -> Optional[ModelType]:
+        """
+        get_daily with its redis calls on the event loop, the row of the day is
+        kept in redis too, so a day's reads after the first need no db query;
+        the db reads of a miss still run in the threadpool, and the read and
+        the write-back are separate round trips, as the row written depends on
+        the one read
+        """
+        today = datetime.strftime(datetime.now(), "%Y%m%d")
+        try:
+            with timer("dependency_duration_seconds", dependency="redis"):
+                redis_data = await redis.hgetall(key)
+        except RedisError as e:
+            logger.warning(f"read {key} failed, use local daily: {e}")
+            return await run_in_threadpool(self._get_daily_local, db, key, today, pick)
+
+        if _is_today(redis_data, today):
+            row = redis_data.get(b"row")
+            if row:
+                # detached, as of when it was picked
+                return self.model(**json.loads(row))
+            db_obj = await run_in_threadpool(
+                self.get, db, id=redis_data.get(b"id").decode("utf-8")
+            )
+            if db_obj:
+                await self._save_daily_async(redis, key, today, db_obj)
+            return db_obj
+
+        # one worker picks it while the others wait for it
+        lock = redis.lock(
+            f"{key}:lock", timeout=DAILY_LOCK_TIMEOUT, blocking_timeout=DAILY_LOCK_TIMEOUT
+        )
+        acquired = False
+        try:
+            acquired = await lock.acquire()
+            redis_data = await redis.hgetall(key)
+        except RedisError as e:
+            await self._release_daily_lock_async(lock, acquired)
+            logger.warning(f"read {key} failed, use local daily: {e}")
+            return await run_in_threadpool(self._get_daily_local, db, key, today, pick)
+        if _is_today(redis_data, today):
+            # picked by another worker meanwhile
+            await self._release_daily_lock_async(lock, acquired)
+            row = redis_data.get(b"row")
+            if row:
+                return self.model(**json.loads(row))
+            return await run_in_threadpool(
+                self.get, db, id=redis_data.get(b"id").decode("utf-8")
+            )
+        if not acquired:
+            logger.warning(f"wait for {key} timed out, use local daily")
+            return await run_in_threadpool(self._get_daily_local, db, key, today, pick)
+
+        try:
+            db_obj = await run_in_threadpool(pick)
+            if db_obj:
+                await self._save_daily_async(redis, key, today, db_obj)
+        finally:
+            await self._release_daily_lock_async(lock, acquired)
+        return db_obj
+
+    async def _save_daily_async(
+        self, redis: AsyncRedis, key: str, today: str, db_obj: ModelType
+    ) -> None:
+        # write back id, day and row in one round trip
+        pipe = redis.pipeline(transaction=False)
+        pipe.hset(
+            key, mapping={"id": db_obj.id, "date": today, "row": _dumps_row(db_obj)}
+        )
+        pipe.expire(key, 60 * 60 * 48)
+        try:
+            await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"save {key} failed: {e}")
+
+    def daily_keys(self) -> List[str]:
+        """redis hashes of the rows of the day"""
+        return [f"{self.model.__tablename__}_daily"]
+
+    def forget_daily_rows(self) -> None:
+        """
+        drop the rows of the day cached whole, an updated or removed row is
+        read again by its id
+        """
+        try:
+            pipe = RedisLocal.pipeline(transaction=False)
+            for key in self.daily_keys():
+                pipe.hdel(key, "row")
+            pipe.execute()
+        except RedisError as e:
+            logger.warning(f"forget {self.model.__tablename__} daily rows failed: {e}")
+
+    @staticmethod
+    def _release_daily_lock(lock, acquired: bool) -> None:
+        # the row of the day is saved already, a lock expired meanwhile is no matter
+        if not acquired:
+            return
+        try:
+            lock.release()
+        except RedisError as e:
+            logger.warning(f"release {lock.name} failed: {e}")
+
+    @staticmethod
+    async def _release_daily_lock_async(lock, acquired: bool) -> None:
+        if not acquired:
+            return
+        try:
+            await lock.release()
+        except RedisError as e:
+            logger.warning(f"release {lock.name} failed: {e}")
+
+    def _get_daily_local(
+        self, db: Session, key: str, today: str, pick: Callable[[], Optional[ModelType]]
+    ) -> Optional[ModelType]:
+        entry = _local_daily.get(key)
+        if entry and entry[0] == today:
+            return self.get(db, id=entry[1])
+        db_obj = pick()
+        if db_obj:
+            _local_daily[key] = (today, db_obj.id)
+        return db_obj
+
+    # counter
+
+    def count(self, db: Session, **filters) -> int:
+        """
+        rows count of the table, or of one value of a group field,
+        read from the redis counters and recounted exactly if they are missing
+        :param db: db session
+        :param filters: at most one group field and its value, e.g. classify="normal"
+        :return: rows count
+        """
+        filters = _group_filters(filters)
+        if len(filters) > 1 or not set(filters) <= set(self.group_fields):
+            return self.count_exact(db, **filters)
+
+        field = "total"
+        for name, value in filters.items():
+            field = _group_field(name, value)
+        try:
+            value = RedisLocal.hget(self.count_key, field)
+            if value is None:
+                value = self.recount(db).get(field, 0)
+            return int(value)
+        except RedisError as e:
+            logger.warning(f"read {self.count_key} counter failed: {e}")
+            return self.count_exact(db, **filters)
+
+    def count_exact(self, db: Session, **filters) -> int:
+        return (
+            db.query(func.count(self.model.id))
+            .filter_by(**_group_filters(filters))
+            .scalar()
+        )
+
+    def recount(self, db: Session) -> Dict[str, int]:
+        """exact recount of all counters, the counters expire to fix any drift"""
+        counters = {"total": self.count_exact(db)}
+        for field in self.group_fields:
+            column = getattr(self.model, field)
+            rows = db.query(column, func.count(self.model.id)).group_by(column)
+            for value, count in rows:
+                counters[_group_field(field, value)] = count
+
+        pipe = RedisLocal.pipeline()
+        pipe.delete(self.count_key)
+        pipe.hset(self.count_key, mapping=counters)
+        pipe.expire(self.count_key, settings.COUNT_RECOUNT_EXPIRE)
+        pipe.execute()
+        return counters
+
+    # random
+
+    def pool_key(self, **filters) -> str:
+        """redis set of ids, of the whole table or of one value of a group field"""
+        key = f"{self.model.__tablename__}_ids"
+        for field, value in _group_filters(filters).items():
+            key += f":{_group_field(field, value)}"
+        return key
+
+    def get_random(self, db: Session, **filters) -> Optional[ModelType]:
+        """random row, picked from the redis id pool instead of sorting the table"""
+        filters = _group_filters(filters)
+        if len(filters) > 1 or not set(filters) <= set(self.group_fields):
+            return self.get_random_exact(db, **filters)
+
+        key = self.pool_key(**filters)
+        try:
+            # a pooled id may be gone if a row was removed behind the pool
+            for _ in range(3):
+                id = RedisLocal.srandmember(key)
+                if id is None:
+                    ids = self.fill_pool(db, **filters)
+                    if not ids:
+                        return None
+                    id = random.choice(ids)
+                db_obj = self.get(db, int(id))
+                if db_obj:
+                    return db_obj
+                RedisLocal.srem(key, id)
+        except RedisError as e:
+            logger.warning(f"read {key} pool failed: {e}")
+        return self.get_random_exact(db, **filters)
+
+    def get_random_multi(
+            self, db: Session, count: int, **filters
+    ) -> List[ModelType]:
+        """
+        distinct random rows, sampled once from the id pool and read by one IN query
+        :param db: db session
+        :param count: rows count, less rows if the table has not enough
+        :param filters: at most one group field and its value
+        :return: db models in random order
+        """
+        filters = _group_filters(filters)
+        if len(filters) > 1 or not set(filters) <= set(self.group_fields):
+            return self._get_random_multi_exact(db, count, **filters)
+
+        key = self.pool_key(**filters)
+        try:
+            ids = [int(id) for id in RedisLocal.srandmember(key, count)]
+            if not ids:
+                ids = self.fill_pool(db, **filters)
+                ids = random.sample(ids, min(count, len(ids)))
+        except RedisError as e:
+            logger.warning(f"read {key} pool failed: {e}")
+            return self._get_random_multi_exact(db, count, **filters)
+
+        # srandmember returns the members in set order
+        random.shuffle(ids)
+        db_objs = self.get_multi_by_ids(db, ids)
+        if len(db_objs) == len(ids):
+            return db_objs
+
+        # rows removed behind the pool, drop their ids and top up from it
+        try:
+            for _ in range(3):
+                found = {db_obj.id for db_obj in db_objs}
+                RedisLocal.srem(key, *(set(ids) - found))
+                if len(db_objs) >= count:
+                    return db_objs
+                ids = [
+                    int(id) for id in RedisLocal.srandmember(key, count)
+                    if int(id) not in found
+                ][:count - len(db_objs)]
+                if not ids:
+                    # the pool has no more rows
+                    return db_objs
+                more = self.get_multi_by_ids(db, ids)
+                db_objs.extend(more)
+                if len(more) == len(ids):
+                    return db_objs
+        except RedisError as e:
+            logger.warning(f"read {key} pool failed: {e}")
+        return self._get_random_multi_exact(db, count, **filters)
+
+    def _get_random_multi_exact(
+            self, db: Session, count: int, **filters
+    ) -> List[ModelType]:
+        query = db.query(self.model.id).filter_by(**_group_filters(filters))
+        ids = [row.id for row in query]
+        return self.get_multi_by_ids(db, random.sample(ids, min(count, len(ids))))
+
+    def get_multi_by_ids(self, db: Session, ids: List[int]) -> List[ModelType]:
+        """rows of the ids in the same order, missing ones are skipped"""
+        if not ids:
+            return []
+        db_objs = {
+            db_obj.id: db_obj
+            for db_obj in db.query(self.model).filter(self.model.id.in_(ids))
+        }
+        return [db_objs[id] for id in ids if id in db_objs]
+
+    def get_random_unseen(
+            self, db: Session, seen_key: str, **filters
+    ) -> Optional[ModelType]:
+        """
+        random row whose id is not set in a redis bitmap, and set it,
+        once every row is seen the bitmap is cleared for a new round
+        :param db: db session
+        :param seen_key: redis bitmap of the seen ids, e.g. one per user
+        :param filters: at most one group field and its value
+        :return: db model
+        """
+        filters = _group_filters(filters)
+        if len(filters) > 1 or not set(filters) <= set(self.group_fields):
+            return self.get_random_exact(db, **filters)
+
+        key = self.pool_key(**filters)
+        try:
+            for _ in range(3):
+                id = self._random_unseen_id(db, key, seen_key, filters)
+                if id is None:
+                    return None
+                db_obj = self.get(db, id)
+                if db_obj:
+                    pipe = RedisLocal.pipeline()
+                    pipe.setbit(seen_key, id, 1)
+                    pipe.expire(seen_key, settings.SEEN_EXPIRE)
+                    pipe.execute()
+                    return db_obj
+                RedisLocal.srem(key, id)
+        except RedisError as e:
+            logger.warning(f"read {seen_key} bitmap failed: {e}")
+        return self.get_random(db, **filters)
+
+    def _random_unseen_id(
+            self, db: Session, key: str, seen_key: str, filters: Dict[str, Any]
+    ) -> Optional[int]:
+        # uniform among the unseen ones of a uniform sample is uniform among all
+        # unseen, so grow the sample only when most of the pool is seen
+        for size in (8, 128):
+            ids = [int(id) for id in RedisLocal.srandmember(key, size)]
+            if not ids:
+                ids = self.fill_pool(db, **filters)
+                if not ids:
+                    return None
+            unseen = self._unseen(seen_key, ids)
+            if unseen:
+                return random.choice(unseen)
+            if len(ids) < size:
+                break
+
+        members = [int(id) for id in RedisLocal.smembers(key)]
+        unseen = self._unseen(seen_key, members)
+        if unseen:
+            return random.choice(unseen)
+
+        # everything of the pool is seen, a new round of it,
+        # the ids of other group values stay seen
+        if filters:
+            pipe = RedisLocal.pipeline()
+            for id in members:
+                pipe.setbit(seen_key, id, 0)
+            pipe.execute()
+        else:
+            RedisLocal.delete(seen_key)
+        return random.choice(ids)
+
+    def _unseen(self, seen_key: str, ids: List[int]) -> List[int]:
+        pipe = RedisLocal.pipeline()
+        for id in ids:
+            pipe.getbit(seen_key, id)
+        return [id for id, seen in zip(ids, pipe.execute()) if not seen]
+
+    def get_random_exact(self, db: Session, **filters) -> Optional[ModelType]:
+        """random row by a random offset, it walks an index instead of sorting"""
+        count = self.count_exact(db, **filters)
+        if not count:
+            return None
+        return (
+            db.query(self.model)
+            .filter_by(**_group_filters(filters))
+            .order_by(self.model.id)
+            .offset(random.randrange(count))
+            .first()
+        )
+
+    def fill_pool(self, db: Session, **filters) -> List[int]:
+        """load the ids into the redis pool, the pool expires to fix any drift"""
+        key = self.pool_key(**filters)
+        query = db.query(self.model.id).filter_by(**_group_filters(filters))
+        ids = [row.id for row in query]
+
+        pipe = RedisLocal.pipeline()
+        pipe.delete(key)
+        for i in range(0, len(ids), 10000):
+            pipe.sadd(key, *ids[i:i + 10000])
+        pipe.expire(key, settings.ID_POOL_EXPIRE)
+        pipe.execute()
+        return ids
+
+    # cache maintenance
+
+    def cache_row(
+            self, db_obj: ModelType, amount: int = 1, groups: Dict[str, Any] = None
+    ) -> None:
+        """
+        keep the counters and id pools in step with a created or removed row
+        :param db_obj: db model
+        :param amount: 1 if the row was created, -1 if removed
+        :param groups: group values of the row, default db_obj's
+        """
+        if groups is None:
+            groups = self._groups(db_obj)
+        counters = ["total"] + [_group_field(f, v) for f, v in groups.items()]
+        pools = [self.pool_key()] + [self.pool_key(**{f: v}) for f, v in groups.items()]
+        keys = [self.count_key] + pools
+
+        try:
+            pipe = RedisLocal.pipeline()
+            for field in counters:
+                pipe.hincrby(self.count_key, field, amount)
+            for key in pools:
+                if amount > 0:
+                    pipe.sadd(key, db_obj.id)
+                else:
+                    pipe.srem(key, db_obj.id)
+            for key in keys:
+                pipe.ttl(key)
+            ttls = pipe.execute()[-len(keys):]
+            # a key expired meanwhile, so the write created it again partially
+            # and without expire, drop it to rebuild on next read
+            expired = [key for key, ttl in zip(keys, ttls) if ttl == -1]
+            if expired:
+                RedisLocal.delete(*expired)
+        except RedisError as e:
+            logger.warning(f"update {self.model.__tablename__} cache failed: {e}")
+            self.reset_cache()
+
+    def reset_cache(self) -> None:
+        """drop the counters and id pools, bulk writes call it to rebuild on next read"""
+        try:
+            pools = RedisLocal.scan_iter(match=f"{self.pool_key()}*")
+            RedisLocal.delete(self.count_key, *pools)
+        except RedisError as e:
+            logger.warning(f"reset {self.model.__tablename__} cache failed: {e}")
+
+    def _groups(self, db_obj: ModelType) -> Dict[str, Any]:
+        return {
+            field: _group_value(getattr(db_obj, field)) for field in self.group_fields
+        }
+
+
+def _is_today(redis_data: Dict[bytes, bytes], today: str) -> bool:
+    return bool(redis_data) and redis_data.get(b"date").decode("utf-8") == today
+
+
+def _dumps_row(db_obj: Base) -> str:
+    return json.dumps(
+        {column.name: getattr(db_obj, column.name) for column in db_obj.__table__.columns}
+    )
+
+
+def _group_value(value: Any) -> Any:
+    # enum field value stored as its plain value
+    return getattr(value, "value", value)
+
+
+def _group_field(field: str, value: Any) -> str:
+    return f"{field}:{_group_value(value)}"
+
+
+def _group_filters(filters: Dict[str, Any]) -> Dict[str, Any]:
+    # None means not filtered
+    return {
+        field: _group_value(value)
+        for field, value in filters.items()
+        if value is not None
+    }
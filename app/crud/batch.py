@@ -0,0 +1,87 @@
+"""
+Group commit
+
+With WRITE_BATCH_ENABLED the creates of concurrent requests are inserted in
+one transaction: the first create waits WRITE_BATCH_WINDOW_MS for others to
+join, or until WRITE_BATCH_MAX_SIZE have, then commits them all at once and
+every request gets the id of its own row. One commit, one fsync and one turn
+of the sqlite write lock are shared by the batch instead of paid by each.
+
+A batch failing to commit, e.g. one row breaking a unique constraint, is
+inserted again row by row, so only the request of the bad row fails.
+"""
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, List, Tuple, Type
+
+from loguru import logger
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.database import Base, engine
+from app.metrics import inc
+
+
+class WriteBatcher:
+    """inserts of concurrent threads committed together"""
+
+    def __init__(self, bind: Engine, window: float, max_size: int):
+        self.bind = bind
+        self.window = window
+        self.max_size = max_size
+        self._pending: List[Tuple[Type[Base], Dict[str, Any], Future]] = []
+        self._lock = threading.Lock()
+        self._full = threading.Event()
+
+    def insert(self, model: Type[Base], obj_data: Dict[str, Any]) -> int:
+        """insert a new row with the others of its batch, return its id"""
+        future: Future = Future()
+        with self._lock:
+            self._pending.append((model, obj_data, future))
+            # the first row of a batch commits it
+            leader = len(self._pending) == 1
+            if len(self._pending) >= self.max_size:
+                self._full.set()
+
+        if leader:
+            self._full.wait(self.window)
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._full.clear()
+            inc("db_write_batches_total")
+            inc("db_write_batch_rows_total", len(batch))
+            self._commit(batch)
+        return future.result()
+
+    def _commit(self, batch: List[Tuple[Type[Base], Dict[str, Any], Future]]) -> None:
+        try:
+            ids = self._insert([model(**obj_data) for model, obj_data, _ in batch])
+        except SQLAlchemyError as e:
+            if len(batch) == 1:
+                batch[0][2].set_exception(e)
+                return
+            logger.warning(f"batch of {len(batch)} rows failed, insert one by one: {e}")
+            for row in batch:
+                self._commit([row])
+            return
+        except BaseException as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            raise
+        for (_, _, future), id in zip(batch, ids):
+            future.set_result(id)
+
+    def _insert(self, db_objs: List[Base]) -> List[int]:
+        with Session(bind=self.bind) as session:
+            session.add_all(db_objs)
+            session.flush()
+            ids = [db_obj.id for db_obj in db_objs]
+            session.commit()
+        return ids
+
+
+write_batcher = WriteBatcher(
+    engine, settings.WRITE_BATCH_WINDOW_MS / 1000, settings.WRITE_BATCH_MAX_SIZE
+)
@@ -1,46 +1,142 @@
-from datetime import datetime
-from typing import Optional
+import random
+from functools import lru_cache
+from typing import Dict, Hashable, Optional, Tuple, List
 
 from .base import CRUDBase
+from app.config import settings
 from app.models.psychology import Psychology
 
-from app.schemas.psychology import PsychologyCreate, PsychologyUpdate
+from app.schemas.psychology import PsychologyCreate, PsychologyUpdate, PsychologyClassifyEnum
 from redis import Redis
-from sqlalchemy import func
+from redis.asyncio import Redis as AsyncRedis
 from sqlalchemy.orm import Session
 
-from app.database import engine
-
 
 class CRUDPsychology(CRUDBase[Psychology, PsychologyCreate, PsychologyUpdate]):
-    def get_psychology_random(self, db: Session) -> Psychology:
-        if engine.name == "sqlite" or "postgresql":
-            return db.query(Psychology).order_by(func.random()).first()
-        elif engine.name == "mysql":
-            return db.query(Psychology).order_by(func.rand()).first()
-        elif engine.name == "oracle":
-            return db.query(Psychology).order_by("dbms_random.value").first()
-
-    def get_psychology_daily(self, db: Session, redis: Redis) -> Optional[Psychology]:
-        # get cache from redis
-        redis_data = redis.hgetall("psychology_daily")
-        # only time equal current day read from redis
-        if redis_data and redis_data.get(b"date").decode("utf-8") == datetime.strftime(
-            datetime.now(), "%Y%m%d"
-        ):
-            # get psychology model
-            db_psychology = self.get(db, id=redis_data.get(b"id").decode("utf-8"))
-        else:
-            # if time not today, get random from db
-            # and then save to redis cache
-            db_psychology = self.get_psychology_random(db)
-            if not db_psychology:
-                return None
-            redis.hset("psychology_daily", "id", db_psychology.id)
-            now = datetime.strftime(datetime.now(), "%Y%m%d")
-            redis.hset("psychology_daily", "date", now)
-
-        return db_psychology
-
-
-psychology = CRUDPsychology(Psychology)
\ No newline at end of file
+    group_fields = ("classify",)
+
+    def get_psychology_random(
+        self,
+        db: Session,
+        classify: Optional[PsychologyClassifyEnum] = None,
+        *,
+        weighted: bool = False,
+        seen_key: Optional[str] = None,
+    ) -> Optional[Psychology]:
+        """
+        read psychology random
+        :param db: db session
+        :param classify: only read this classify
+        :param weighted: pick the classify by PSYCHOLOGY_CLASSIFY_WEIGHTS first
+        :param seen_key: redis bitmap of seen ids, only read unseen psychology
+        :return: psychology
+        """
+        if weighted and not classify:
+            # the picked classify may be empty, try again
+            for _ in range(3):
+                db_psychology = self._random(db, classify_alias_table().sample(), seen_key)
+                if db_psychology:
+                    return db_psychology
+        return self._random(db, classify, seen_key)
+
+    def get_psychology_random_multi(
+        self,
+        db: Session,
+        count: int,
+        classify: Optional[PsychologyClassifyEnum] = None,
+    ) -> List[Psychology]:
+        return self.get_random_multi(db, count, classify=classify)
+
+    def _random(
+        self, db: Session, classify: Optional[str], seen_key: Optional[str]
+    ) -> Optional[Psychology]:
+        if seen_key:
+            return self.get_random_unseen(db, seen_key, classify=classify)
+        return self.get_random(db, classify=classify)
+
+    def get_psychology_daily(
+        self,
+        db: Session,
+        redis: Redis,
+        classify: Optional[PsychologyClassifyEnum] = None,
+    ) -> Optional[Psychology]:
+        return self.get_daily(
+            db,
+            redis,
+            _daily_key(classify),
+            lambda: self.get_psychology_random(db, classify=classify),
+        )
+
+    async def get_psychology_daily_async(
+        self,
+        db: Session,
+        redis: AsyncRedis,
+        classify: Optional[PsychologyClassifyEnum] = None,
+    ) -> Optional[Psychology]:
+        return await self.get_daily_async(
+            db,
+            redis,
+            _daily_key(classify),
+            lambda: self.get_psychology_random(db, classify=classify),
+        )
+
+    def daily_keys(self) -> List[str]:
+        return [_daily_key(None)] + [_daily_key(classify) for classify in PsychologyClassifyEnum]
+
+
+def _daily_key(classify: Optional[PsychologyClassifyEnum]) -> str:
+    # every classify has its own daily psychology
+    if classify:
+        return f"psychology_daily:{classify.value}"
+    return "psychology_daily"
+
+
+class AliasTable:
+    """
+    weighted random choice in O(1) by Vose's alias method,
+    the table is built once in O(n)
+    """
+
+    def __init__(self, weights: Dict[Hashable, float]):
+        self.items = [item for item, weight in weights.items() if weight > 0]
+        if not self.items:
+            raise ValueError("at least one positive weight")
+
+        n = len(self.items)
+        total = sum(weights[item] for item in self.items)
+        scaled = [weights[item] * n / total for item in self.items]
+
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+
+    def sample(self, rng: Optional[random.Random] = None) -> Hashable:
+        rng = rng or random
+        i = rng.randrange(len(self.items))
+        if rng.random() < self.prob[i]:
+            return self.items[i]
+        return self.items[self.alias[i]]
+
+
+def classify_alias_table() -> AliasTable:
+    weights = {classify.value: 1.0 for classify in PsychologyClassifyEnum}
+    weights.update(settings.PSYCHOLOGY_CLASSIFY_WEIGHTS)
+    return _alias_table(tuple(sorted(weights.items())))
+
+
+@lru_cache()
+def _alias_table(weights: Tuple[Tuple[str, float], ...]) -> AliasTable:
+    return AliasTable(dict(weights))
+
+
+psychology = CRUDPsychology(Psychology)
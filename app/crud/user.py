@@ -32,6 +32,7 @@ class CRUDUser(CRUDBase[User, UserCreate, UserUpdate]):
         db.add(db_user)
         db.commit()
         db.refresh(db_user)
+        self.cache_row(db_user)
         return db_user
 
     def create_superuser(self, db: Session, *, obj: UserCreate) -> User:
@@ -49,6 +50,7 @@ class CRUDUser(CRUDBase[User, UserCreate, UserUpdate]):
         db.add(db_superuser)
         db.commit()
         db.refresh(db_superuser)
+        self.cache_row(db_superuser)
         return db_superuser
 
     def update(
@@ -1,22 +1,177 @@
-from typing import Any
+import threading
+import time
+from typing import Any, Dict, Iterator, Tuple, List, Optional
 
-import redis
-from sqlalchemy import create_engine
+from loguru import logger
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import as_declarative, declared_attr
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.sql import Insert, Update, Delete
+from sqlalchemy.pool import QueuePool
+from app.cache import MemoryRedis, AsyncMemoryRedis
 from app.config import settings
+from app.deadlines import instrument_deadlines
+from app.metrics import COLLECTORS, inc
+from app.queries import instrument_engine
+from app.redis_client import create_redis, create_async_redis
+
+
+def engine_options(uri: str) -> Dict[str, Any]:
+    """create_engine options of a database url, by backend"""
+    options = {
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+        "query_cache_size": settings.DB_QUERY_CACHE_SIZE,
+    }
+    url = make_url(uri)
+    if url.get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}
+        if url.database and url.database != ":memory:":
+            # a file db keeps its connections, pragmas run once per connection
+            options["poolclass"] = QueuePool
+        else:
+            return options
+
+    options.update(
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+    )
+    return options
+
+
+def sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """storage tuning of every new sqlite connection"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={settings.SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT}")
+    cursor.close()
+
+
+def make_engine(uri: str, name: str) -> Engine:
+    """an engine tuned by its backend, instrumented and reporting its pool"""
+    db_engine = create_engine(uri, **engine_options(uri))
+    if db_engine.dialect.name == "sqlite":
+        event.listen(db_engine, "connect", sqlite_pragmas)
+    event.listen(
+        db_engine, "connect", lambda *args: inc("db_pool_connects_total", engine=name)
+    )
+    event.listen(
+        db_engine, "checkout", lambda *args: inc("db_pool_checkouts_total", engine=name)
+    )
+    instrument_engine(db_engine)
+    instrument_deadlines(db_engine)
+    COLLECTORS.append(lambda: pool_gauges(db_engine, name))
+    return db_engine
+
+
+def pool_stats(db_engine: Engine) -> Dict[str, int]:
+    """connections of a queue pool: size, idle, in use and overflow"""
+    pool = db_engine.pool
+    if not isinstance(pool, QueuePool):
+        return {}
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": max(pool.overflow(), 0),
+    }
+
+
+def pool_gauges(db_engine: Engine, name: str) -> Iterator[Tuple[str, Dict[str, Any], float]]:
+    for state, value in pool_stats(db_engine).items():
+        yield "db_pool_connections", {"engine": name, "state": state}, value
+
+
+class ReplicaSet:
+    """
+    read replicas chosen round-robin,
+    a replica failing to connect is skipped for REPLICA_RETRY_INTERVAL seconds
+    """
+
+    def __init__(self, engines: List[Engine]):
+        self.engines = engines
+        self._next = 0
+        self._down_until: Dict[Engine, float] = {}
+        self._lock = threading.Lock()
+        for replica in engines:
+            event.listen(replica, "handle_error", self._handle_error)
+
+    def __len__(self) -> int:
+        return len(self.engines)
+
+    def choose(self) -> Optional[Engine]:
+        """next healthy replica, None if all are down"""
+        now = time.monotonic()
+        with self._lock:
+            for _ in range(len(self.engines)):
+                replica = self.engines[self._next]
+                self._next = (self._next + 1) % len(self.engines)
+                if self._down_until.get(replica, 0) <= now:
+                    return replica
+        return None
+
+    def mark_down(self, replica: Engine) -> None:
+        logger.warning(f"replica {replica.url!r} is down")
+        self._down_until[replica] = time.monotonic() + settings.REPLICA_RETRY_INTERVAL
+
+    def _handle_error(self, context) -> None:
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+            self.mark_down(context.engine)
+
+
+class RoutingSession(Session):
+    """
+    session of a read only request reading from a replica,
+    writes, and every read after the first write, go to the primary
+    """
+
+    def __init__(self, *args, replicas: Optional[ReplicaSet] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replicas = replicas
+        self.read_only = False
+        self.wrote = False
+        # one replica for every read of the session
+        self._replica: Optional[Engine] = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        primary = super().get_bind(mapper, clause, **kwargs)
+        if isinstance(clause, (Insert, Update, Delete)) or self._flushing:
+            self.wrote = True
+        if not self.read_only or self.wrote or not self.replicas:
+            return primary
+
+        if self._replica is None:
+            self._replica = self.replicas.choose() or primary
+        return self._replica
+
 
 # db engine
-engine = create_engine(settings.DATABASE_URI, connect_args={"check_same_thread": False})
-# redis engine
-redis_engine = redis.ConnectionPool(
-    host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB
+engine = make_engine(settings.DATABASE_URI, "primary")
+replicas = ReplicaSet(
+    [
+        make_engine(uri, f"replica{index}")
+        for index, uri in enumerate(settings.DATABASE_REPLICA_URIS)
+    ]
 )
+# redis clients, shared and behind one circuit breaker,
+# or the cache of this process
+if settings.CACHE_BACKEND == "memory":
+    RedisLocal = MemoryRedis()
+    AsyncRedisLocal = AsyncMemoryRedis(RedisLocal)
+else:
+    RedisLocal = create_redis()
+    AsyncRedisLocal = create_async_redis(RedisLocal.breaker)
 
-RedisLocal = redis.Redis(connection_pool=redis_engine)
-
-# local db session
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# local db session, set read_only to read from the replicas
+SessionLocal = sessionmaker(
+    class_=RoutingSession, autocommit=False, autoflush=False, bind=engine, replicas=replicas
+)
 
 
 # init db create all db model to db tables
@@ -0,0 +1,120 @@
+"""
+Request deadlines
+
+A request has REQUEST_TIMEOUT seconds, or the REQUEST_TIMEOUTS one of its
+route, shortened by a client sending `X-Request-Timeout: <seconds>`, counted
+from its arrival stamped by DeadlineMiddleware, so the time spent waiting for
+admission or a pool thread is taken from its budget. Its db
+session keeps the deadline and every transaction the session begins gets
+the time left as a statement timeout: `SET LOCAL statement_timeout` on
+postgres, a progress handler interrupting the statement on sqlite.
+
+A statement cancelled at the deadline raises DeadlineExceeded, answered 504,
+so a slow query stops holding its connection and thread once the client
+has given up.
+"""
+import time
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+from starlette.requests import Request
+from starlette.types import ASGIApp, Scope, Receive, Send
+
+from app.admission import match_route
+from app.config import settings
+
+DEADLINE_HEADER = "X-Request-Timeout"
+# monotonic time the request arrived at, in its scope
+ARRIVAL_KEY = "arrived_at"
+# sqlite vm instructions between deadline checks
+SQLITE_PROGRESS_STEPS = 1000
+# postgres query_canceled
+PG_QUERY_CANCELED = "57014"
+
+
+class DeadlineExceeded(Exception):
+    """the request deadline passed, its statement was cancelled"""
+
+
+def request_deadline(request: Request) -> Optional[float]:
+    """monotonic deadline of a request, None if it has none"""
+    timeout = match_route(settings.REQUEST_TIMEOUTS, request.url.path)
+    if timeout is None:
+        timeout = settings.REQUEST_TIMEOUT
+    try:
+        asked = float(request.headers.get(DEADLINE_HEADER, 0))
+    except ValueError:
+        asked = 0
+    # a client can only shorten it
+    if asked > 0:
+        timeout = min(timeout, asked) if timeout else asked
+    if not timeout:
+        return None
+    return request.scope.get(ARRIVAL_KEY, time.monotonic()) + timeout
+
+
+class DeadlineMiddleware:
+    """stamp the arrival of a request, its deadline counts from there"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            scope[ARRIVAL_KEY] = time.monotonic()
+        await self.app(scope, receive, send)
+
+
+def instrument_deadlines(db_engine: Engine) -> None:
+    """cancel the statements of a session past its deadline, see set_deadline"""
+    event.listen(db_engine, "handle_error", _handle_error)
+    event.listen(db_engine, "checkin", _clear_deadline)
+
+
+def set_deadline(db: Session, deadline: Optional[float]) -> None:
+    db.info["deadline"] = deadline
+
+
+@event.listens_for(Session, "after_begin")
+def _apply_deadline(session: Session, transaction, connection: Connection) -> None:
+    deadline = session.info.get("deadline")
+    if deadline is None:
+        return
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("request deadline exceeded")
+
+    connection.info["deadline"] = deadline
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        # reset by the end of the transaction
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {max(int(left * 1000), 1)}")
+    elif dialect == "sqlite":
+        connection.connection.set_progress_handler(
+            lambda: time.monotonic() > deadline, SQLITE_PROGRESS_STEPS
+        )
+
+
+def _clear_deadline(dbapi_connection, connection_record) -> None:
+    # the connection goes back to the pool, the next session has its own deadline
+    if connection_record.info.pop("deadline", None) is not None:
+        if hasattr(dbapi_connection, "set_progress_handler"):
+            dbapi_connection.set_progress_handler(None, 0)
+
+
+def is_cancelled(context) -> bool:
+    """the statement of a failed execution was cancelled at its deadline"""
+    if context.connection is None or "deadline" not in context.connection.info:
+        return False
+    error = context.original_exception
+    return (
+        getattr(error, "pgcode", None) == PG_QUERY_CANCELED
+        or context.engine.dialect.name == "sqlite" and str(error) == "interrupted"
+    )
+
+
+def _handle_error(context) -> None:
+    if is_cancelled(context):
+        raise DeadlineExceeded("request deadline exceeded") from context.original_exception
@@ -1,39 +1,66 @@
 # get db session
-from jose import jwt
-from fastapi import Depends, HTTPException
+import math
+from functools import partial
+from typing import Callable
+
+from fastapi import Depends, HTTPException, Request, Response
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import ValidationError
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from sqlalchemy import event
 from sqlalchemy.orm import Session
-from loguru import logger
 from app import models, schemas
 from app.config import settings
-from app.database import SessionLocal, RedisLocal
+from app.database import SessionLocal, RedisLocal, AsyncRedisLocal
+from app.deadlines import request_deadline, set_deadline
+from app.metrics import timer
+from app.ratelimit import rate_limiter
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=f"{settings.API_V1_STR}/login")
 
+# a client that wrote reads from the primary while this cookie lives
+PRIMARY_COOKIE = "soul_primary"
+
 
-def get_db():
+def get_db(request: Request, response: Response):
     db = SessionLocal()
+    # statements past the request deadline are cancelled
+    set_deadline(db, request_deadline(request))
+    # read only requests read from a replica, but not just after the client wrote
+    db.read_only = request.method in ("GET", "HEAD") and not request.cookies.get(
+        PRIMARY_COOKIE
+    )
+    if db.replicas:
+        event.listen(db, "after_commit", partial(_stick_to_primary, response))
     try:
         yield db
     finally:
         db.close()
 
 
-def get_redis_db():
-    redis = RedisLocal
-    try:
-        yield redis
-    except Exception as e:
-        logger.error(e)
-    finally:
-        redis.close()
+def _stick_to_primary(response: Response, session) -> None:
+    if session.wrote:
+        response.set_cookie(
+            PRIMARY_COOKIE, "1", max_age=settings.REPLICA_STICKY_SECONDS, httponly=True
+        )
+
+
+def get_redis_db() -> Redis:
+    # the shared client, its pooled connections are kept between requests
+    return RedisLocal
+
+
+async def get_async_redis() -> AsyncRedis:
+    # the shared asyncio client, for async routes
+    return AsyncRedisLocal
 
 
 def get_current_user(
     db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)
 ) -> models.User:
     """get current user by token"""
+    from jose import jwt
 
     try:
         # verify jwt token
@@ -46,7 +73,8 @@ def get_current_user(
         raise HTTPException(status_code=403, detail="Could not validate credentials")
 
     # get user by unpacked id
-    user = db.query(models.User).get(token_data.sub)
+    with timer("dependency_duration_seconds", dependency="user_lookup"):
+        user = db.query(models.User).get(token_data.sub)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
@@ -78,3 +106,31 @@ def get_current_confirm_user(
     if not current_user.is_confirm:
         raise HTTPException(status_code=400, detail="The user doesn't confirmed")
     return current_user
+
+
+def _check_rate_limit(quota: str, identity: str) -> None:
+    wait = rate_limiter.hit(quota, identity)
+    if wait:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(max(1, math.ceil(wait)))},
+        )
+
+
+def limit_by_user(quota: str) -> Callable[..., None]:
+    """dependency limiting a route per current user by the RATE_LIMITS quota"""
+
+    def dependency(current_user: models.User = Depends(get_current_user)) -> None:
+        _check_rate_limit(quota, f"user:{current_user.id}")
+
+    return dependency
+
+
+def limit_by_ip(quota: str) -> Callable[..., None]:
+    """dependency limiting a route per client ip by the RATE_LIMITS quota"""
+
+    def dependency(request: Request) -> None:
+        _check_rate_limit(quota, f"ip:{request.client.host}")
+
+    return dependency
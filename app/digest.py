@@ -0,0 +1,190 @@
+"""
+Daily digest mailer
+
+`manage.py digest send` mails today's word and psychology to every
+confirmed user. The digest is rendered once, users are streamed by id in
+batches and the last sent id of the day is saved in redis after every
+batch, so a stopped job resumes where it was. Users a digest failed to reach
+are kept in a set next to it and sent to first when the job runs again.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import Iterator, List, Tuple, TYPE_CHECKING
+
+from loguru import logger
+from sqlalchemy.orm import Session
+
+from app import crud
+from app.config import settings
+from app.database import RedisLocal
+from app.lunar import get_lunar
+from app.models.user import User
+from app.utils import email_templates, get_smtp_options
+
+if TYPE_CHECKING:
+    from emails.backend.smtp import SMTPBackend
+
+
+class RateLimiter:
+    """allow at most rate calls per second over all threads, 0 is unlimited"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            at = max(self._next, now)
+            self._next = at + self.interval
+        time.sleep(at - now)
+
+
+class DigestSender:
+    """send one rendered digest with a smtp connection kept by every thread"""
+
+    def __init__(self, subject: str, html: str, rate: float):
+        self.subject = subject
+        self.html = html
+        self.limiter = RateLimiter(rate)
+        self._local = threading.local()
+        self._backends: List["SMTPBackend"] = []
+
+    def send(self, email_to: str) -> bool:
+        import emails
+        from emails.backend.smtp import SMTPBackend
+
+        if not hasattr(self._local, "smtp"):
+            self._local.smtp = SMTPBackend(**get_smtp_options())
+            self._backends.append(self._local.smtp)
+
+        self.limiter.wait()
+        message = emails.Message(
+            subject=self.subject,
+            html=self.html,
+            mail_from=(settings.EMAILS_FROM_NAME, settings.EMAILS_FROM_EMAIL),
+        )
+        try:
+            response = message.send(to=email_to, smtp=self._local.smtp)
+        except Exception as e:
+            logger.warning(f"send digest to {email_to} failed: {e}")
+            return False
+        return response.status_code == 250
+
+    def close(self) -> None:
+        for backend in self._backends:
+            backend.close()
+
+
+def render_digest(db: Session) -> str:
+    """render today's digest, the same for every user"""
+    word = crud.word.get_word_daily(db, RedisLocal)
+    psychology = crud.psychology.get_psychology_daily(db, RedisLocal)
+    return email_templates.get("daily_digest.html").render(
+        project_name=settings.PROJECT_NAME,
+        word=word,
+        psychology=psychology,
+        lunar=get_lunar(date.today()),
+    )
+
+
+def iter_recipients(
+    db: Session, after_id: int, batch_size: int
+) -> Iterator[List[Tuple[int, str]]]:
+    """batches of (id, email) of confirmed users, streamed by a server side cursor"""
+    query = (
+        db.query(User.id, User.email)
+        .filter(User.is_confirm.is_(True), User.is_active.is_(True), User.id > after_id)
+        .order_by(User.id)
+        .execution_options(stream_results=True)
+        .yield_per(batch_size)
+    )
+    batch = []
+    for row in query:
+        batch.append((row.id, row.email))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def failed_recipients(
+    db: Session, ids: List[int], batch_size: int
+) -> Iterator[List[Tuple[int, str]]]:
+    """batches of (id, email) of the users of ids still confirmed"""
+    ids = sorted(ids)
+    for i in range(0, len(ids), batch_size):
+        rows = (
+            db.query(User.id, User.email)
+            .filter(
+                User.is_confirm.is_(True),
+                User.is_active.is_(True),
+                User.id.in_(ids[i:i + batch_size]),
+            )
+            .order_by(User.id)
+            .all()
+        )
+        if rows:
+            yield [(row.id, row.email) for row in rows]
+
+
+def send_digest(
+    db: Session, *, batch_size: int, concurrency: int, rate: float, restart: bool = False
+) -> Tuple[int, int]:
+    """
+    send today's digest to every confirmed user, resume today's progress
+    :return: sent and failed count
+    """
+    assert settings.EMAILS_ENABLED, "no provided configuration for email variables"
+
+    progress_key = f"digest:{date.today():%Y%m%d}"
+    failed_key = f"{progress_key}:failed"
+    if restart:
+        RedisLocal.delete(progress_key, failed_key)
+    after_id = int(RedisLocal.hget(progress_key, "last_id") or 0)
+    retry_ids = [int(id) for id in RedisLocal.smembers(failed_key)]
+    if after_id:
+        logger.info(f"resume digest after user {after_id}, retry {len(retry_ids)} failed")
+
+    sender = DigestSender(
+        f"{settings.PROJECT_NAME} - Daily digest", render_digest(db), rate
+    )
+    sent = failed = 0
+
+    def send_batch(batch: List[Tuple[int, str]], retry: bool) -> None:
+        nonlocal sent, failed
+        results = list(executor.map(sender.send, [email for _, email in batch]))
+        sent += sum(results)
+        failed += len(results) - sum(results)
+
+        pipe = RedisLocal.pipeline()
+        if not retry:
+            pipe.hset(progress_key, "last_id", batch[-1][0])
+        pipe.hincrby(progress_key, "sent", sum(results))
+        # a failed user is sent to again on resume, not skipped with last_id
+        failed_ids = [id for (id, _), ok in zip(batch, results) if not ok]
+        sent_ids = [id for (id, _), ok in zip(batch, results) if ok]
+        if failed_ids:
+            pipe.sadd(failed_key, *failed_ids)
+        if retry and sent_ids:
+            pipe.srem(failed_key, *sent_ids)
+        pipe.expire(progress_key, 60 * 60 * 24 * 2)
+        pipe.expire(failed_key, 60 * 60 * 24 * 2)
+        pipe.execute()
+        logger.info(f"digest sent {sent}, failed {failed}")
+
+    try:
+        with ThreadPoolExecutor(concurrency) as executor:
+            for batch in failed_recipients(db, retry_ids, batch_size):
+                send_batch(batch, retry=True)
+            for batch in iter_recipients(db, after_id, batch_size):
+                send_batch(batch, retry=False)
+    finally:
+        sender.close()
+    return sent, failed
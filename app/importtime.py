@@ -0,0 +1,47 @@
+"""
+Import time report
+
+A module is imported cold in a new interpreter with `-X importtime`, the
+wall time of the import and the self and cumulative time of every module
+imported by it are parsed from the output.
+"""
+import subprocess
+import sys
+from typing import List, NamedTuple, Tuple
+
+# printed by the child after the import, its wall time in seconds
+_WALL = "wall:"
+
+
+class ImportTime(NamedTuple):
+    module: str
+    self_us: int  # microseconds importing the module itself
+    cumulative_us: int  # microseconds including its imports
+    depth: int  # nesting level, 0 for the measured module and other top level imports
+
+
+def measure_import(module: str = "app.main") -> Tuple[float, List[ImportTime]]:
+    """
+    import a module in a new interpreter
+    :return: wall seconds of the import and the time of every imported module
+    """
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; print('{_WALL}', time.perf_counter() - start)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall = float(result.stdout.split(_WALL)[-1])
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append(ImportTime(name.strip(), int(self_us), int(cumulative_us), depth))
+    return wall, times
@@ -0,0 +1,174 @@
+"""
+Precomputed lunar calendar table
+
+lunar_python computes the jieqi of a whole year for every date, so the
+lunar date and ganzhi of every day in LUNAR_TABLE_START ~ LUNAR_TABLE_END
+are computed once by `manage.py lunar build` and packed in a file:
+
+    header: magic, first day ordinal, days count
+    record: month (negative for leap month), day, year / month / day ganzhi
+            index in the 60 cycle, 5 bytes per day
+
+The file is memory mapped on first use, a day is one slice of it.
+lunar_python is slow to import and imported on first use too.
+"""
+import mmap
+import os
+import struct
+from datetime import date, timedelta
+from functools import lru_cache
+from multiprocessing import Pool
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from app.config import settings
+
+MAGIC = b"SOULLUNA"
+HEADER = struct.Struct("<8sII")
+RECORD = struct.Struct("<bBBBB")
+
+
+def compute_lunar(day: date) -> Dict[str, str]:
+    """lunar date and ganzhi of a solar day, computed by lunar_python"""
+    from lunar_python import Solar
+
+    lunar = Solar.fromYmd(day.year, day.month, day.day).getLunar()
+    return {
+        "date": f"{lunar.getMonthInChinese()}月{lunar.getDayInChinese()}",
+        "ganzhi_year": lunar.getYearInGanZhi(),
+        "ganzhi_month": lunar.getMonthInGanZhi(),
+        "ganzhi_day": lunar.getDayInGanZhi(),
+        "shengxiao": lunar.getYearShengXiao(),
+    }
+
+
+def get_lunar(day: date) -> Dict[str, str]:
+    """lunar date and ganzhi of a solar day"""
+    lunar = lunar_table().get(day)
+    if lunar is None:
+        lunar = _compute_lunar_cached(day)
+    return lunar
+
+
+def get_lunar_range(start: date, end: date) -> List[Dict[str, str]]:
+    """lunar date and ganzhi of every day in start ~ end, both included"""
+    lunars = lunar_table().range(start, end)
+    if lunars is None:
+        days = (end - start).days + 1
+        lunars = [_compute_lunar_cached(start + timedelta(i)) for i in range(days)]
+    return lunars
+
+
+@lru_cache(maxsize=1024)
+def _compute_lunar_cached(day: date) -> Dict[str, str]:
+    return compute_lunar(day)
+
+
+class LunarTable:
+    """memory mapped lunar table, None for days out of it or without the file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.start = 0
+        self.days = 0
+        self._mmap = None
+
+        if not os.path.exists(path):
+            logger.info(f"no lunar table {path}, lunar is computed")
+            return
+
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.start, self.days = HEADER.unpack_from(self._mmap)
+        assert magic == MAGIC, f"{path} is not a lunar table"
+
+    def get(self, day: date) -> Optional[Dict[str, str]]:
+        lunars = self.range(day, day)
+        return lunars[0] if lunars else None
+
+    def range(self, start: date, end: date) -> Optional[List[Dict[str, str]]]:
+        first = start.toordinal() - self.start
+        last = end.toordinal() - self.start
+        if self._mmap is None or first < 0 or last >= self.days:
+            return None
+
+        offset = HEADER.size + first * RECORD.size
+        records = self._mmap[offset:offset + (last - first + 1) * RECORD.size]
+        return [_unpack(*record) for record in RECORD.iter_unpack(records)]
+
+
+@lru_cache()
+def lunar_table() -> LunarTable:
+    """the lunar table is loaded on first use"""
+    return LunarTable(table_path())
+
+
+def table_path() -> str:
+    here = os.path.abspath(os.path.dirname(__file__))
+    return os.path.join(here, settings.LUNAR_TABLE_PATH)
+
+
+def _ganzhi(index: int) -> str:
+    from lunar_python.util import LunarUtil
+
+    return LunarUtil.GAN[index % 10 + 1] + LunarUtil.ZHI[index % 12 + 1]
+
+
+def _unpack(month: int, day: int, year_gz: int, month_gz: int, day_gz: int) -> Dict[str, str]:
+    from lunar_python.util import LunarUtil
+
+    return {
+        "date": f"{'闰' if month < 0 else ''}{LunarUtil.MONTH[abs(month)]}月{LunarUtil.DAY[day]}",
+        "ganzhi_year": _ganzhi(year_gz),
+        "ganzhi_month": _ganzhi(month_gz),
+        "ganzhi_day": _ganzhi(day_gz),
+        "shengxiao": LunarUtil.SHENGXIAO[year_gz % 12 + 1],
+    }
+
+
+# build
+
+
+def _sexagenary(gan: int, zhi: int) -> int:
+    # index in the 60 cycle of a gan and zhi index
+    return (6 * gan - 5 * zhi) % 60
+
+
+def _pack_year(year: int) -> bytes:
+    from lunar_python import Solar
+
+    records = []
+    day = date(year, 1, 1)
+    while day.year == year:
+        lunar = Solar.fromYmd(day.year, day.month, day.day).getLunar()
+        records.append(
+            RECORD.pack(
+                lunar.getMonth(),
+                lunar.getDay(),
+                _sexagenary(lunar.getYearGanIndex(), lunar.getYearZhiIndex()),
+                _sexagenary(lunar.getMonthGanIndex(), lunar.getMonthZhiIndex()),
+                _sexagenary(lunar.getDayGanIndex(), lunar.getDayZhiIndex()),
+            )
+        )
+        day += timedelta(1)
+    return b"".join(records)
+
+
+def build_lunar_table(start: int, end: int, path: str, processes: int = None) -> int:
+    """
+    compute the lunar table of years start ~ end and write it to path
+    :return: days count
+    """
+    with Pool(processes) as pool:
+        years = pool.map(_pack_year, range(start, end + 1))
+
+    days = (date(end, 12, 31) - date(start, 1, 1)).days + 1
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, date(start, 1, 1).toordinal(), days))
+        f.writelines(years)
+    os.replace(tmp_path, path)
+
+    lunar_table.cache_clear()
+    return days
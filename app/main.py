@@ -1,7 +1,15 @@
-from fastapi import FastAPI, APIRouter
+import asyncio
 
+from fastapi import FastAPI, APIRouter, Request
+from fastapi.responses import PlainTextResponse
+
+from app.admission import AdmissionMiddleware
 from app.config import settings
-from app.routers import psychologies_router, user_router, login_router, utils_router, word_router, me_router
+from app.deadlines import DeadlineExceeded, DeadlineMiddleware
+from app.metrics import MetricsMiddleware, TimedJSONResponse, render as render_metrics
+from app.queries import QueryStatsMiddleware
+from app.profiler import ProfileMiddleware, ProfiledExecutor
+from app.routers import psychologies_router, user_router, login_router, utils_router, word_router, me_router, today_router
 
 # openapi tags metadata
 tags_metadata = [
@@ -12,7 +20,11 @@ tags_metadata = [
     {
         "name": "words",
         "description": "Manage words translation. Even you can get them daily.",
-    }
+    },
+    {
+        "name": "today",
+        "description": "Daily word, daily psychology and lunar date in one call.",
+    },
 ]
 
 app = FastAPI(
@@ -20,8 +32,21 @@ app = FastAPI(
     description="The Soul api",
     version="1.0.0",
     openapi_tags=tags_metadata,
+    default_response_class=TimedJSONResponse,
 )
 
+app.add_middleware(QueryStatsMiddleware)
+app.add_middleware(ProfileMiddleware)
+
+if settings.ADMISSION_ENABLED:
+    app.add_middleware(AdmissionMiddleware)
+
+# outside of admission, the deadline counts the wait in line
+app.add_middleware(DeadlineMiddleware)
+
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 # api v1 router
 app_v1 = APIRouter()
 
@@ -33,10 +58,30 @@ app_v1.include_router(user_router, prefix="/users", tags=["users"])
 app_v1.include_router(me_router, prefix="/me", tags=["me"])
 app_v1.include_router(login_router, tags=["login"])
 app_v1.include_router(utils_router, prefix="/utils", tags=["utils"])
+app_v1.include_router(today_router, tags=["today"])
 
 app.include_router(app_v1, prefix=settings.API_V1_STR)
 
 
+@app.on_event("startup")
+async def set_default_executor():
+    # sync endpoints and dependencies run here, profiled with their request
+    asyncio.get_running_loop().set_default_executor(ProfiledExecutor())
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded(request: Request, exc: DeadlineExceeded):
+    return TimedJSONResponse({"detail": "Request deadline exceeded"}, status_code=504)
+
+
 @app.get("/")
 def home():
     return {"message": settings.DATABASE_URI}
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def metrics():
+    """metrics of this worker in prometheus text format"""
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -0,0 +1,206 @@
+"""
+Request metrics
+
+Counters and latency histograms of routes and dependencies, exported in
+prometheus text format at /metrics.
+
+Every thread updates its own shard, so recording takes no lock, /metrics
+sums the shards. The metrics are of one worker process.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Tuple, Any, Callable, Iterable
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+# name: (type, help)
+METRICS = {
+    "http_requests_total": ("counter", "Requests count by route and status"),
+    "http_request_duration_seconds": ("histogram", "Request latency by route"),
+    "dependency_duration_seconds": (
+        "histogram",
+        "Latency of user lookup, redis, bcrypt and serialization",
+    ),
+    "db_pool_connections": ("gauge", "Db pool connections by engine and state"),
+    "db_pool_connects_total": ("counter", "Db connections opened by engine"),
+    "db_pool_checkouts_total": ("counter", "Db connections checked out by engine"),
+    "http_requests_shed_total": ("counter", "Requests answered 503 by admission control"),
+    "admission_requests": ("gauge", "Requests running and queued by route group"),
+    "rate_limited_total": ("counter", "Requests answered 429 by quota"),
+    "db_write_batches_total": ("counter", "Group commits of concurrent creates"),
+    "db_write_batch_rows_total": ("counter", "Rows inserted by group commits"),
+}
+
+# gauges read when rendered, functions returning (name, labels, value)
+COLLECTORS: List[Callable[[], Iterable[Tuple[str, Dict[str, Any], float]]]] = []
+
+# latency histogram buckets in seconds
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+_local = threading.local()
+_shards: List[Dict[Tuple[str, LabelsKey], List[float]]] = []
+_shards_lock = threading.Lock()
+
+
+def _shard() -> Dict[Tuple[str, LabelsKey], List[float]]:
+    shard = getattr(_local, "shard", None)
+    if shard is None:
+        shard = _local.shard = {}
+        # only taken once by every thread
+        with _shards_lock:
+            _shards.append(shard)
+    return shard
+
+
+def inc(name: str, amount: float = 1, **labels: Any) -> None:
+    """add to a counter"""
+    key = (name, tuple(sorted(labels.items())))
+    shard = _shard()
+    value = shard.get(key)
+    if value is None:
+        shard[key] = [amount]
+    else:
+        value[0] += amount
+
+
+def observe(name: str, value: float, **labels: Any) -> None:
+    """add a value to a histogram, values are kept as bucket counts, sum and count"""
+    key = (name, tuple(sorted(labels.items())))
+    shard = _shard()
+    histogram = shard.get(key)
+    if histogram is None:
+        histogram = shard[key] = [0] * (len(BUCKETS) + 3)
+    histogram[bisect_left(BUCKETS, value)] += 1
+    histogram[-2] += value
+    histogram[-1] += 1
+
+
+@contextmanager
+def timer(name: str, **labels: Any):
+    """observe the seconds a block takes"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def render() -> str:
+    """all metrics in prometheus text format"""
+    merged: Dict[Tuple[str, LabelsKey], List[float]] = {}
+    with _shards_lock:
+        shards = list(_shards)
+    for shard in shards:
+        for key, values in list(shard.items()):
+            total = merged.get(key)
+            if total is None:
+                merged[key] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    total[i] += value
+
+    for collect in COLLECTORS:
+        for name, labels, value in collect():
+            merged[(name, tuple(sorted(labels.items())))] = [value]
+
+    lines = []
+    for name, (kind, help) in METRICS.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (metric, labels), values in sorted(merged.items()):
+            if metric != name:
+                continue
+            if kind in ("counter", "gauge"):
+                lines.append(f"{name}{_labels(labels)} {values[0]}")
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), values):
+                cumulative += count
+                le = labels + (("le", str(bound)),)
+                lines.append(f"{name}_bucket{_labels(le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {values[-2]}")
+            lines.append(f"{name}_count{_labels(labels)} {values[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+def _labels(labels: LabelsKey) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_route_paths: Dict[Any, str] = {}
+
+
+def route_path(scope: Scope) -> str:
+    """path template of the route a request matched, e.g. /api/v1/words/{wid}"""
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    path = _route_paths.get(endpoint)
+    if path is None:
+        for route in scope["app"].routes:
+            if getattr(route, "endpoint", None) is endpoint:
+                path = _route_paths[endpoint] = route.path
+                break
+        else:
+            path = "unmatched"
+    return path
+
+
+class MetricsMiddleware:
+    """count and time every request by its route path"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # the router sets the matched endpoint in scope
+            route = route_path(scope)
+            observe(
+                "http_request_duration_seconds",
+                time.perf_counter() - start,
+                method=scope["method"],
+                route=route,
+            )
+            inc(
+                "http_requests_total",
+                method=scope["method"],
+                route=route,
+                status=status,
+            )
+
+
+class TimedJSONResponse(JSONResponse):
+    """json response timing its serialization"""
+
+    def render(self, content: Any) -> bytes:
+        with timer("dependency_duration_seconds", dependency="serialization"):
+            return super().render(content)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, Index
 
 from app.database import Base
 
@@ -9,3 +9,6 @@ class Psychology(Base):
     knowledge = Column(String, index=True)  # 知识点
     created_at = Column(String)
     updated_at = Column(String)
+
+    # filter and page by classify
+    __table_args__ = (Index("ix_psychology_classify_id", "classify", "id"),)
@@ -0,0 +1,195 @@
+"""
+Email outbox
+
+The api pushes email tasks to a redis list, `manage.py worker emails`
+pops and sends them with pooled smtp connections, failed tasks are
+retried with backoff and dropped to a dead list after EMAILS_MAX_ATTEMPTS.
+Emails popped by a worker that stopped sending heartbeats are moved
+back to the outbox by the other workers.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Any, TYPE_CHECKING
+
+from fastapi import BackgroundTasks
+from loguru import logger
+from redis import RedisError
+
+from app.database import RedisLocal
+from app.config import settings
+from app.utils import (
+    email_templates,
+    get_smtp_options,
+    send_test_email,
+    send_confirm_email,
+    send_reset_password_email,
+)
+
+if TYPE_CHECKING:
+    from emails.backend.smtp import SMTPBackend
+
+OUTBOX_KEY = "email_outbox"
+RETRY_KEY = "email_outbox:retry"  # sorted set, score is the due time
+DEAD_KEY = "email_outbox:dead"
+PROCESSING_KEY = "email_outbox:processing"
+HEARTBEAT_KEY = "email_outbox:heartbeat"
+HEARTBEAT_TTL = 30  # seconds a worker without heartbeats is seen as dead
+
+# email tasks the worker can send, by name
+EMAIL_TASKS: Dict[str, Callable[..., bool]] = {
+    task.__name__: task
+    for task in (send_test_email, send_confirm_email, send_reset_password_email)
+}
+
+
+def queue_email(
+    background_tasks: BackgroundTasks, task: Callable[..., bool], **kwargs
+) -> None:
+    """
+    push an email task to the outbox,
+    send it in background of this request if redis is not available
+    :param background_tasks: request background tasks
+    :param task: one of EMAIL_TASKS
+    :param kwargs: task params
+    """
+    assert task.__name__ in EMAIL_TASKS, f"unknown email task {task.__name__}"
+    try:
+        RedisLocal.lpush(OUTBOX_KEY, _dumps(task.__name__, kwargs, attempts=0))
+    except RedisError as e:
+        logger.warning(f"queue email failed, send in background: {e}")
+        background_tasks.add_task(task, **kwargs)
+
+
+def process_email(raw: bytes, smtp: "SMTPBackend") -> bool:
+    """send one email task, schedule a retry or drop it to the dead list if failed"""
+    message = json.loads(raw)
+    task = EMAIL_TASKS.get(message["task"])
+
+    try:
+        sent = task is not None and task(smtp=smtp, **message["kwargs"])
+    except Exception as e:
+        logger.exception(e)
+        sent = False
+    if sent:
+        return True
+
+    attempts = message["attempts"] + 1
+    if task is None or attempts >= settings.EMAILS_MAX_ATTEMPTS:
+        logger.error(f"drop email task {message['task']} after {attempts} attempts")
+        RedisLocal.lpush(DEAD_KEY, raw)
+    else:
+        due = time.time() + settings.EMAILS_RETRY_BACKOFF * 2 ** (attempts - 1)
+        retry = _dumps(message["task"], message["kwargs"], attempts=attempts)
+        RedisLocal.zadd(RETRY_KEY, {retry: due})
+    return False
+
+
+def move_due_retries() -> int:
+    """move the email tasks due to retry back to the outbox"""
+    moved = 0
+    for raw in RedisLocal.zrangebyscore(RETRY_KEY, 0, time.time(), start=0, num=100):
+        # only the worker removing it moves it
+        if RedisLocal.zrem(RETRY_KEY, raw):
+            RedisLocal.lpush(OUTBOX_KEY, raw)
+            moved += 1
+    return moved
+
+
+def requeue_orphans() -> int:
+    """move the emails of processing lists without a live worker back to the outbox"""
+    moved = 0
+    for processing in RedisLocal.scan_iter(match=f"{PROCESSING_KEY}:*"):
+        if isinstance(processing, bytes):
+            processing = processing.decode("utf-8")
+        worker = processing[len(PROCESSING_KEY) + 1 :].rsplit(":", 1)[0]
+        if RedisLocal.exists(f"{HEARTBEAT_KEY}:{worker}"):
+            continue
+        while RedisLocal.rpoplpush(processing, OUTBOX_KEY):
+            moved += 1
+    if moved:
+        logger.warning(f"requeued {moved} emails of dead workers")
+    return moved
+
+
+def run_email_worker(concurrency: int) -> None:
+    """
+    send emails from the outbox until interrupted,
+    every thread keeps its own smtp connection open between emails
+    """
+    email_templates.load()
+
+    # unique per process, so workers sharing a hostname have their own lists
+    worker = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    try:
+        # alive before the threads pop any email
+        _heartbeat(worker)
+    except RedisError as e:
+        logger.warning(e)
+
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=_email_worker_thread,
+            args=(worker, index, stop),
+            name=f"email-{index}",
+        )
+        for index in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    logger.info(f"email worker started with {concurrency} threads")
+
+    swept = 0.0
+    try:
+        while not stop.is_set():
+            try:
+                _heartbeat(worker)
+                if time.monotonic() - swept > HEARTBEAT_TTL:
+                    requeue_orphans()
+                    swept = time.monotonic()
+                move_due_retries()
+            except RedisError as e:
+                logger.warning(e)
+            stop.wait(1)
+    except KeyboardInterrupt:
+        logger.info("email worker stopping")
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def _email_worker_thread(worker: str, index: int, stop: threading.Event) -> None:
+    # an email popped but not sent yet is kept in the processing list of this
+    # thread, once the heartbeats of this worker are gone another worker, or
+    # this one restarted, sends it again
+    from emails.backend.smtp import SMTPBackend
+
+    processing = f"{PROCESSING_KEY}:{worker}:{index}"
+    smtp = SMTPBackend(**get_smtp_options())
+
+    try:
+        while not stop.is_set():
+            try:
+                raw = RedisLocal.brpoplpush(OUTBOX_KEY, processing, timeout=1)
+                if raw is None:
+                    continue
+                process_email(raw, smtp)
+                RedisLocal.lrem(processing, 1, raw)
+            except RedisError as e:
+                logger.warning(e)
+                stop.wait(1)
+    finally:
+        smtp.close()
+
+
+def _heartbeat(worker: str) -> None:
+    RedisLocal.set(f"{HEARTBEAT_KEY}:{worker}", 1, ex=HEARTBEAT_TTL)
+
+
+def _dumps(task: str, kwargs: Dict[str, Any], attempts: int) -> str:
+    return json.dumps({"task": task, "kwargs": kwargs, "attempts": attempts})
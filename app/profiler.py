@@ -0,0 +1,202 @@
+"""
+Sampling profiler
+
+A thread takes the stacks of every other thread of the worker at a fixed
+interval and counts them, the process runs as usual in between, so live
+traffic can be profiled without restarting under a profiler.
+
+Stacks are output collapsed, one `thread;module:function;... count` line
+per stack, ready for flamegraph.pl or speedscope.
+
+`/utils/profile?seconds=` profiles the worker for a while, a superuser
+request with a `X-Profile: 1` header is profiled alone: only the event loop
+and the pool threads running its sync endpoint and dependencies are sampled,
+its profile is stored and the id returned in the `X-Profile` response header.
+The pool threads are known by ProfiledExecutor, the default executor of the
+event loop.
+"""
+import sys
+import threading
+import uuid
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any, Callable, Optional, Set
+
+from loguru import logger
+from redis import RedisError
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+from app.config import settings
+from app.database import RedisLocal, SessionLocal
+from app.models.user import User
+
+PROFILE_KEY = "profile"
+
+# one profile at a time, samplers would take each other's stacks
+profile_lock = threading.Lock()
+
+
+class Sampler:
+    """count the stacks of all threads, or of one request, every interval seconds"""
+
+    def __init__(self, interval: float, request_thread: Optional[int] = None):
+        self.interval = interval
+        # the event loop thread of the profiled request, None to sample all threads
+        self.request_thread = request_thread
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        # pool threads running the sync code of the profiled request
+        self._threads: Set[int] = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self) -> "Sampler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> "Sampler":
+        self._stop.set()
+        self._thread.join()
+        return self
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me or not self._is_sampled(ident):
+                    continue
+                self.stacks[_collapse(names.get(ident, str(ident)), frame)] += 1
+            self.samples += 1
+
+    def _is_sampled(self, ident: int) -> bool:
+        return (
+            self.request_thread is None
+            or ident == self.request_thread
+            or ident in self._threads
+        )
+
+    def run_sampled(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """run fn in this pool thread, sampled while it runs"""
+        ident = threading.get_ident()
+        self._threads.add(ident)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._threads.discard(ident)
+
+    def collapsed(self) -> str:
+        """stacks in collapsed format, most sampled first"""
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+
+# sampler of the profiled request, sync endpoints run in a copy of the context
+_request_sampler: ContextVar[Optional[Sampler]] = ContextVar(
+    "request_sampler", default=None
+)
+
+
+class ProfiledExecutor(ThreadPoolExecutor):
+    """
+    default executor of the event loop, run_in_threadpool submits from the
+    request's context, so the functions of a profiled request are sampled
+    """
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        sampler = _request_sampler.get()
+        if sampler is None:
+            return super().submit(fn, *args, **kwargs)
+        return super().submit(sampler.run_sampled, fn, *args, **kwargs)
+
+
+def _collapse(thread: str, frame) -> str:
+    functions = []
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "?")
+        functions.append(f"{module}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    functions.append(thread)
+    return ";".join(reversed(functions))
+
+
+def save_profile(collapsed: str) -> Optional[str]:
+    """store a profile for PROFILE_EXPIRE seconds, return its id"""
+    profile_id = uuid.uuid4().hex
+    try:
+        RedisLocal.set(f"{PROFILE_KEY}:{profile_id}", collapsed, ex=settings.PROFILE_EXPIRE)
+    except RedisError as e:
+        logger.warning(f"save profile failed: {e}")
+        return None
+    return profile_id
+
+
+def get_profile(profile_id: str) -> Optional[str]:
+    collapsed = RedisLocal.get(f"{PROFILE_KEY}:{profile_id}")
+    return collapsed.decode("utf-8") if collapsed is not None else None
+
+
+def _is_superuser(authorization: str) -> bool:
+    from jose import jwt
+
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer":
+        return False
+    try:
+        payload = jwt.decode(
+            token, settings.SECRET_KEY, algorithms=[settings.TOKEN_ALGORITHMS]
+        )
+    except jwt.JWTError:
+        return False
+
+    db = SessionLocal()
+    try:
+        user = db.query(User).get(payload.get("sub"))
+        return bool(user and user.is_active and user.is_superuser)
+    finally:
+        db.close()
+
+
+class ProfileMiddleware:
+    """profile a superuser request with a X-Profile header"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        if (
+            not headers.get("X-Profile")
+            or not await run_in_threadpool(_is_superuser, headers.get("Authorization", ""))
+            or not profile_lock.acquire(blocking=False)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        sampler = Sampler(
+            settings.PROFILE_INTERVAL_MS / 1000, request_thread=threading.get_ident()
+        )
+        token = _request_sampler.set(sampler)
+        sampler.start()
+
+        async def send_wrapper(message: Message) -> None:
+            # the endpoint is done once the response starts
+            if message["type"] == "http.response.start":
+                sampler.stop()
+                profile_id = await run_in_threadpool(save_profile, sampler.collapsed())
+                if profile_id:
+                    MutableHeaders(scope=message)["X-Profile"] = profile_id
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stop()
+            _request_sampler.reset(token)
+            profile_lock.release()
@@ -0,0 +1,126 @@
+"""
+SQL query instrumentation
+
+Cursor events of the engine count the queries of every request and the
+time spent in them, statements slower than SQL_SLOW_QUERY_MS are logged
+with their route, and a request issuing the same statement again is
+warned about, the usual shape of an N+1 or of a redundant lookup.
+
+With SQL_QUERY_HEADERS the count and time are sent as X-Query-Count and
+X-Query-Time (ms) response headers.
+"""
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional, Any
+
+from loguru import logger
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+from app.config import settings
+from app.metrics import route_path
+
+
+class QueryStats:
+    """queries of one request"""
+
+    def __init__(self, scope: Scope):
+        self.scope = scope
+        self.count = 0
+        self.seconds = 0.0
+        self.statements: Counter = Counter()
+
+    def add(self, statement: str, parameters: Any, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        self.statements[(statement, repr(parameters))] += 1
+
+    def repeated(self) -> Counter:
+        """statements issued more than once with the same parameters"""
+        return Counter({key: n for key, n in self.statements.items() if n > 1})
+
+    def similar(self) -> Counter:
+        """statements issued SQL_REPEAT_THRESHOLD times at least with any parameters"""
+        counts: Counter = Counter()
+        for (statement, _), n in self.statements.items():
+            counts[statement] += n
+        return Counter(
+            {s: n for s, n in counts.items() if n >= settings.SQL_REPEAT_THRESHOLD}
+        )
+
+
+# stats of the current request, sync endpoints run in a copy of the context
+# and share the same stats object
+_query_stats: ContextVar[Optional[QueryStats]] = ContextVar(
+    "query_stats", default=None
+)
+
+
+def current_query_stats() -> Optional[QueryStats]:
+    return _query_stats.get()
+
+
+def instrument_engine(engine: Engine) -> None:
+    """count and time the queries of an engine"""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - context._query_start
+    stats = _query_stats.get()
+    if stats is not None:
+        stats.add(statement, parameters, seconds)
+
+    if seconds * 1000 >= settings.SQL_SLOW_QUERY_MS:
+        route = route_path(stats.scope) if stats else "no request"
+        logger.warning(
+            f"slow query {seconds * 1000:.1f}ms in {route}: {statement} {parameters!r}"
+        )
+
+
+class QueryStatsMiddleware:
+    """collect the queries of every request, warn about repeated statements"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats(scope)
+        token = _query_stats.set(stats)
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start" and settings.SQL_QUERY_HEADERS:
+                headers = MutableHeaders(scope=message)
+                headers["X-Query-Count"] = str(stats.count)
+                headers["X-Query-Time"] = f"{stats.seconds * 1000:.2f}"
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _query_stats.reset(token)
+            _warn_repeated(stats)
+
+
+def _warn_repeated(stats: QueryStats) -> None:
+    if not stats.count:
+        return
+    route = f"{stats.scope['method']} {route_path(stats.scope)}"
+    for (statement, parameters), n in stats.repeated().items():
+        logger.warning(
+            f"identical query issued {n} times in {route}: {statement} {parameters}"
+        )
+    for statement, n in stats.similar().items():
+        logger.warning(f"possible N+1, query issued {n} times in {route}: {statement}")
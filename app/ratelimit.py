@@ -0,0 +1,147 @@
+"""
+Rate limiter
+
+Routes are limited by RATE_LIMITS quotas per user or client ip, with a token
+bucket per quota and client kept in redis and taken from by an atomic lua
+script, so every worker shares the same budget.
+
+A worker takes a few tokens at once, up to RATE_LIMIT_LEASE, a tenth of the
+quota and the tokens refilled in RATE_LIMIT_LEASE_SECONDS, and spends them
+locally for RATE_LIMIT_LEASE_SECONDS, so most allowed requests of a busy
+client need no redis round trip. While redis is
+down, or with the memory cache, the buckets are kept in this process.
+"""
+import math
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from redis import RedisError
+
+from app.config import settings
+from app.database import RedisLocal
+from app.metrics import inc
+
+RATE_LIMIT_KEY = "rate_limit"
+PURGE_INTERVAL = 60  # seconds between sweeps of the idle local buckets
+
+# take up to ARGV[3] tokens of the bucket KEYS[1] holding ARGV[1] at most and
+# refilled ARGV[2] per second, return the tokens taken and the ms to wait if none
+TOKEN_BUCKET = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local want = tonumber(ARGV[3])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local taken = math.min(want, math.floor(tokens))
+tokens = tokens - taken
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+local wait = 0
+if taken == 0 then
+    wait = math.ceil((1 - tokens) / rate * 1000)
+end
+return {taken, wait}
+"""
+
+
+def lease_size(capacity: int, rate: float) -> int:
+    """
+    tokens taken from redis at once, few enough to keep the workers fair and
+    to be spent by a client within the quota before the lease runs out
+    """
+    refilled = math.floor(rate * settings.RATE_LIMIT_LEASE_SECONDS)
+    return max(1, min(settings.RATE_LIMIT_LEASE, capacity // 10, refilled))
+
+
+class RateLimiter:
+    """token buckets in redis, leased a few tokens at a time"""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._script = None
+        # key: [tokens, expire at] leased from redis
+        self._leases: Dict[str, List[float]] = {}
+        # key: [tokens, refilled at] of the buckets while redis is down
+        self._buckets: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+        self._purged = time.monotonic()
+
+    def hit(self, quota: str, identity: str) -> float:
+        """
+        spend a token of the quota of a client
+        :param quota: name of a RATE_LIMITS quota
+        :param identity: the client, e.g. user:1 or ip:127.0.0.1
+        :return: 0 if allowed, else seconds to wait for the next token
+        """
+        limits = settings.RATE_LIMITS.get(quota)
+        if limits is None:
+            # quotas left out of RATE_LIMITS are not limited
+            return 0
+        capacity = int(limits["requests"])
+        rate = capacity / limits["seconds"]
+        key = f"{RATE_LIMIT_KEY}:{quota}:{identity}"
+
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            lease = self._leases.get(key)
+            if lease and lease[0] >= 1 and lease[1] > now:
+                lease[0] -= 1
+                return 0
+
+        want = lease_size(capacity, rate)
+        try:
+            taken, wait_ms = self._take(key, capacity, rate, want)
+        except RedisError:
+            # limited by this process alone
+            taken, wait_ms = self._take_local(key, capacity, rate, want, now)
+
+        if not taken:
+            inc("rate_limited_total", quota=quota)
+            return wait_ms / 1000
+        if taken > 1:
+            with self._lock:
+                lease = self._leases.get(key)
+                if lease and lease[1] > now:
+                    # leased by another thread meanwhile, keep its tokens too
+                    lease[0] += taken - 1
+                else:
+                    self._leases[key] = [taken - 1, now + settings.RATE_LIMIT_LEASE_SECONDS]
+        return 0
+
+    def _take(self, key: str, capacity: int, rate: float, want: int) -> Tuple[int, int]:
+        if self._script is None:
+            self._script = self.redis.register_script(TOKEN_BUCKET)
+        taken, wait_ms = self._script(keys=[key], args=[capacity, rate, want])
+        return int(taken), int(wait_ms)
+
+    def _take_local(
+        self, key: str, capacity: int, rate: float, want: int, now: float
+    ) -> Tuple[int, int]:
+        # the token bucket of the script
+        with self._lock:
+            bucket = self._buckets.setdefault(key, [capacity, now])
+            tokens = min(capacity, bucket[0] + max(0.0, now - bucket[1]) * rate)
+            taken = min(want, math.floor(tokens))
+            bucket[:] = [tokens - taken, now]
+        wait_ms = 0 if taken else math.ceil((1 - bucket[0]) / rate * 1000)
+        return taken, wait_ms
+
+    def _purge(self, now: float) -> None:
+        # leases run out and idle buckets are full again, drop them
+        if now - self._purged < PURGE_INTERVAL:
+            return
+        self._purged = now
+        idle = max((limits["seconds"] for limits in settings.RATE_LIMITS.values()), default=0)
+        self._leases = {key: lease for key, lease in self._leases.items() if lease[1] > now}
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items() if now - bucket[1] < idle
+        }
+
+
+rate_limiter = RateLimiter(RedisLocal)
@@ -0,0 +1,184 @@
+"""
+Resilient redis client
+
+One pooled client is shared by the process, its connections are kept open
+and health checked. A circuit breaker in front of it fails fast while redis
+is down: after REDIS_BREAKER_FAILURES connection errors in a row, commands
+raise at once for REDIS_BREAKER_RESET seconds, then one command is let
+through to try redis again. Callers catch RedisError and fall back.
+
+An asyncio client sharing the breaker serves the async routes on the event
+loop, it has a pool of its own as asyncio connections can't be shared.
+"""
+import threading
+import time
+
+import redis
+import redis.asyncio
+from loguru import logger
+from redis import RedisError
+from redis.client import Pipeline
+
+from app.config import settings
+
+
+class CircuitOpenError(RedisError):
+    """redis is taken as down, the command is not sent"""
+
+
+class CircuitBreaker:
+    def __init__(self, failures: int, reset: float):
+        self.failures = failures
+        self.reset = reset
+        self._failed = 0
+        self._open_until = 0.0
+        self._trying = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._failed >= self.failures
+
+    def call(self, command, *args, **kwargs):
+        trial = self._before()
+        try:
+            result = command(*args, **kwargs)
+        except (redis.ConnectionError, redis.TimeoutError):
+            self._failure()
+            raise
+        except RedisError:
+            # redis answered, e.g. NOSCRIPT or a wrong type, it is up
+            self._success()
+            raise
+        finally:
+            if trial:
+                self._trying = False
+        self._success()
+        return result
+
+    async def call_async(self, command, *args, **kwargs):
+        trial = self._before()
+        try:
+            result = await command(*args, **kwargs)
+        except (redis.ConnectionError, redis.TimeoutError):
+            self._failure()
+            raise
+        except RedisError:
+            # redis answered, e.g. NOSCRIPT or a wrong type, it is up
+            self._success()
+            raise
+        finally:
+            if trial:
+                self._trying = False
+        self._success()
+        return result
+
+    def _before(self) -> bool:
+        """let a command through, return whether it is the trial of an open circuit"""
+        with self._lock:
+            if not self.is_open:
+                return False
+            # after reset seconds one command tries redis again
+            if time.monotonic() < self._open_until or self._trying:
+                raise CircuitOpenError("redis circuit is open")
+            self._trying = True
+            return True
+
+    def _failure(self) -> None:
+        with self._lock:
+            self._failed += 1
+            if self.is_open:
+                if self._failed == self.failures:
+                    logger.warning(f"redis circuit opened for {self.reset}s")
+                self._open_until = time.monotonic() + self.reset
+
+    def _success(self) -> None:
+        if not self._failed:
+            return
+        with self._lock:
+            if self.is_open:
+                logger.info("redis circuit closed")
+            self._failed = 0
+
+
+class ResilientPipeline(Pipeline):
+    def __init__(self, breaker: CircuitBreaker, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    def execute(self, raise_on_error=True):
+        return self.breaker.call(super().execute, raise_on_error)
+
+
+class ResilientRedis(redis.Redis):
+    """redis client whose commands and pipelines go through a circuit breaker"""
+
+    def __init__(self, *args, breaker: CircuitBreaker, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    def execute_command(self, *args, **options):
+        return self.breaker.call(super().execute_command, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ResilientPipeline(
+            self.breaker,
+            self.connection_pool,
+            self.response_callbacks,
+            transaction,
+            shard_hint,
+        )
+
+
+class AsyncResilientPipeline(redis.asyncio.client.Pipeline):
+    def __init__(self, breaker: CircuitBreaker, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    async def execute(self, raise_on_error: bool = True):
+        return await self.breaker.call_async(super().execute, raise_on_error)
+
+
+class AsyncResilientRedis(redis.asyncio.Redis):
+    """asyncio redis client whose commands and pipelines go through a circuit breaker"""
+
+    def __init__(self, *args, breaker: CircuitBreaker, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    async def execute_command(self, *args, **options):
+        return await self.breaker.call_async(super().execute_command, *args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return AsyncResilientPipeline(
+            self.breaker,
+            self.connection_pool,
+            self.response_callbacks,
+            transaction,
+            shard_hint,
+        )
+
+
+def _pool_options():
+    return dict(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=settings.REDIS_DB,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_CONNECT_TIMEOUT,
+        socket_keepalive=True,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+
+
+def create_redis() -> ResilientRedis:
+    breaker = CircuitBreaker(settings.REDIS_BREAKER_FAILURES, settings.REDIS_BREAKER_RESET)
+    return ResilientRedis(
+        connection_pool=redis.ConnectionPool(**_pool_options()), breaker=breaker
+    )
+
+
+def create_async_redis(breaker: CircuitBreaker) -> AsyncResilientRedis:
+    return AsyncResilientRedis(
+        connection_pool=redis.asyncio.ConnectionPool(**_pool_options()), breaker=breaker
+    )
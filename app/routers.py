@@ -1,23 +1,28 @@
-from datetime import timedelta, datetime
-from typing import List, Any
+import time
+from datetime import timedelta, date
+from email.utils import formatdate
+from typing import List, Any, Optional, Union
 
-from fastapi import APIRouter, Depends, HTTPException, Body, BackgroundTasks
-from fastapi.responses import HTMLResponse
+from fastapi import APIRouter, Depends, HTTPException, Body, BackgroundTasks, Response, Query, Request
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from lunar_python import Lunar
 from pydantic import EmailStr
-from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
 from sqlalchemy.orm import Session
 
 from app import schemas, crud, models
 from app.config import settings
+from app.schemas.base import LunarDay
+from app.schemas.today import Today
 from app.depends import (
     get_db,
     get_current_active_superuser,
     get_current_confirm_user,
     get_current_user,
-    get_redis_db,
+    get_async_redis,
     get_current_active_user,
+    limit_by_ip,
+    limit_by_user,
 )
 from app.utils import (
     create_access_token,
@@ -25,20 +30,29 @@ from app.utils import (
     verify_confirm_token,
     send_test_email,
     send_reset_password_email,
+    seconds_until_midnight,
 )
+from app.lunar import get_lunar, get_lunar_range
+from app.outbox import queue_email
+from app.profiler import Sampler, profile_lock, get_profile
 
 psychologies_router = APIRouter()
 
 
 @psychologies_router.get("/", response_model=List[schemas.Psychology])
 def read_psychologies(
+    response: Response,
     db: Session = Depends(get_db),
     skip: int = 0,
     limit: int = 10,
+    classify: Optional[schemas.PsychologyClassifyEnum] = None,
     current_user: models.User = Depends(get_current_confirm_user),
 ) -> Any:
-    """read limited psychologies knowledge"""
-    psychologies = crud.psychology.get_multi(db, skip=skip, limit=limit)
+    """read limited psychologies knowledge, total count in X-Total-Count header"""
+    psychologies = crud.psychology.get_multi(
+        db, skip=skip, limit=limit, classify=classify
+    )
+    response.headers["X-Total-Count"] = str(crud.psychology.count(db, classify=classify))
     return psychologies
 
 
@@ -53,22 +67,43 @@ def create_psychology(
     return crud.psychology.create(db, obj=psychology)
 
 
-@psychologies_router.get("/random", response_model=schemas.Psychology)
+@psychologies_router.get(
+    "/random",
+    response_model=Union[List[schemas.Psychology], schemas.Psychology],
+    dependencies=[Depends(limit_by_user("random"))],
+)
 def read_psychology_random(
     db: Session = Depends(get_db),
+    classify: Optional[schemas.PsychologyClassifyEnum] = None,
+    unseen: bool = Query(False, description="not read twice until all are read"),
+    weighted: bool = Query(False, description="pick classify by weights first"),
+    count: Optional[int] = Query(
+        None, ge=1, le=100, description="read a list of count distinct psychologies"
+    ),
     current_user: models.User = Depends(get_current_confirm_user),
 ) -> Any:
     """read psychology random"""
-    db_psychology = crud.psychology.get_psychology_random(db)
+    if count:
+        if unseen or weighted:
+            raise HTTPException(
+                status_code=400, detail="count can't be used with unseen or weighted"
+            )
+        return crud.psychology.get_psychology_random_multi(db, count, classify=classify)
+
+    seen_key = f"psychology_seen:{current_user.id}" if unseen else None
+    db_psychology = crud.psychology.get_psychology_random(
+        db, classify=classify, weighted=weighted, seen_key=seen_key
+    )
     if not db_psychology:
         raise HTTPException(status_code=404, detail="psychology knowledge not found")
     return db_psychology
 
 
 @psychologies_router.get("/daily", response_model=schemas.Psychology)
-def read_psychology_daily(
+async def read_psychology_daily(
     db: Session = Depends(get_db),
-    redis: Redis = Depends(get_redis_db),
+    redis: AsyncRedis = Depends(get_async_redis),
+    classify: Optional[schemas.PsychologyClassifyEnum] = None,
     current_user: models.User = Depends(get_current_confirm_user),
 ) -> Any:
     """read psychology random every day"""
@@ -76,7 +111,9 @@ def read_psychology_daily(
     # 先从 redis 中取
     # redis 不存在或者不是当天的，从 db 中取
     # 同时写入 redis 缓存
-    db_psychology = crud.psychology.get_psychology_daily(db, redis)
+    db_psychology = await crud.psychology.get_psychology_daily_async(
+        db, redis, classify=classify
+    )
     if not db_psychology:
         raise HTTPException(status_code=404, detail="psychology knowledge not found")
     return db_psychology
@@ -163,14 +200,14 @@ def delete_word(
 
 
 @word_router.get("/daily", response_model=schemas.Word)
-def read_word_daily(
+async def read_word_daily(
     db: Session = Depends(get_db),
-    redis: Redis = Depends(get_redis_db),
+    redis: AsyncRedis = Depends(get_async_redis),
     current_user: models.User = Depends(get_current_confirm_user),
 ) -> Any:
     """read word random every day"""
 
-    db_word = crud.word.get_word_daily(db, redis)
+    db_word = await crud.word.get_word_daily_async(db, redis)
     if not db_word:
         raise HTTPException(status_code=404, detail="word not found")
     return db_word
@@ -226,8 +263,11 @@ def reset_password(
         confirm_token = create_access_token(
             subject=email, expires_delta=timedelta(settings.EMAIL_CONFIRM_TOKEN_EXPIRE)
         )
-        background_tasks.add_task(
-            send_reset_password_email, email_to=email, token=confirm_token
+        queue_email(
+            background_tasks,
+            send_reset_password_email,
+            email_to=email,
+            token=confirm_token,
         )
     return {"msg": "Password reset email sent"}
 
@@ -302,13 +342,15 @@ def update_user(
 # superuser crud user
 @user_router.get("/", response_model=List[schemas.User])
 def read_users(
+    response: Response,
     db: Session = Depends(get_db),
     skip: int = 0,
     limit: int = 10,
     current_user: models.User = Depends(get_current_active_superuser),
 ):
-    """read all users, only for superuser"""
+    """read all users, only for superuser, total count in X-Total-Count header"""
     users = crud.user.get_multi(db, skip=skip, limit=limit)
+    response.headers["X-Total-Count"] = str(crud.user.count(db))
     return users
 
 
@@ -345,14 +387,19 @@ def register(
         confirm_token = create_access_token(
             subject=email, expires_delta=timedelta(settings.EMAIL_CONFIRM_TOKEN_EXPIRE)
         )
-        background_tasks.add_task(
-            send_confirm_email, email_to=user.email, token=confirm_token
+        queue_email(
+            background_tasks,
+            send_confirm_email,
+            email_to=user.email,
+            token=confirm_token,
         )
 
     return user
 
 
-@login_router.post("/login", response_model=schemas.Token)
+@login_router.post(
+    "/login", response_model=schemas.Token, dependencies=[Depends(limit_by_ip("login"))]
+)
 def login(
     db: Session = Depends(get_db), form_data: OAuth2PasswordRequestForm = Depends()
 ):
@@ -410,7 +457,7 @@ def test_email(
     current_user: models.User = Depends(get_current_active_superuser),
 ):
     """test emails server"""
-    background_tasks.add_task(send_test_email, email_to=email_to)
+    queue_email(background_tasks, send_test_email, email_to=email_to)
     return {"msg": "Test email sent"}
 
 
@@ -420,17 +467,90 @@ def test_token(current_user: models.User = Depends(get_current_user)) -> Any:
     return current_user
 
 
-@utils_router.get("/lunar", response_model=schemas.Lunar)
+@utils_router.get(
+    "/lunar", response_model=Union[List[LunarDay], schemas.Lunar]
+)
 def lunar(
+    start: Optional[date] = Query(None, description="first day of a date range"),
+    end: Optional[date] = Query(None, description="last day of a date range"),
     current_user: models.User = Depends(get_current_confirm_user),
 ) -> Any:
-    """get current date in lunar"""
+    """get current date in lunar, or every date in start ~ end"""
+    if start is None and end is None:
+        return get_lunar(date.today())
+
+    if start is None or end is None or not 0 <= (end - start).days <= 366:
+        raise HTTPException(
+            status_code=400, detail="start and end must be a range of at most 366 days"
+        )
+    lunars = get_lunar_range(start, end)
+    return [
+        {"solar": start + timedelta(i), **lunar} for i, lunar in enumerate(lunars)
+    ]
+
+
+@utils_router.get("/profile", response_class=PlainTextResponse)
+def profile(
+    seconds: float = Query(10, gt=0, le=settings.PROFILE_MAX_SECONDS),
+    current_user: models.User = Depends(get_current_active_superuser),
+) -> Any:
+    """sample the stacks of this worker for seconds, return them collapsed for flamegraph"""
+    if not profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="another profile is running")
+    try:
+        sampler = Sampler(settings.PROFILE_INTERVAL_MS / 1000).start()
+        time.sleep(seconds)
+        sampler.stop()
+    finally:
+        profile_lock.release()
+    return PlainTextResponse(sampler.collapsed())
+
+
+@utils_router.get("/profile/{profile_id}", response_class=PlainTextResponse)
+def read_profile(
+    profile_id: str,
+    current_user: models.User = Depends(get_current_active_superuser),
+) -> Any:
+    """read the profile of a request sent with a X-Profile header"""
+    collapsed = get_profile(profile_id)
+    if collapsed is None:
+        raise HTTPException(status_code=404, detail="profile not found")
+    return PlainTextResponse(collapsed)
+
+
+# today router
+today_router = APIRouter()
+
+
+@today_router.get("/today", response_model=Today)
+async def read_today(
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_db),
+    redis: AsyncRedis = Depends(get_async_redis),
+    current_user: models.User = Depends(get_current_confirm_user),
+) -> Any:
+    """read daily word, daily psychology and lunar date in one call, cacheable until midnight"""
+    # the redis calls run on the event loop, the db session and user lookup
+    # of the sync dependencies still run in the threadpool
+    db_word = await crud.word.get_word_daily_async(db, redis)
+    db_psychology = await crud.psychology.get_psychology_daily_async(db, redis)
+
+    # the body only changes at midnight
+    today = date.today()
+    etag = f'"{today:%Y%m%d}-{db_word and db_word.id}-{db_psychology and db_psychology.id}"'
+    max_age = seconds_until_midnight()
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={max_age}",
+        "Expires": formatdate(time.time() + max_age, usegmt=True),
+    }
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers=headers)
 
-    lunar = Lunar.fromDate(datetime.now())
+    response.headers.update(headers)
     return {
-        "date": f"{lunar.getMonthInChinese()}月{lunar.getDayInChinese()}",
-        "ganzhi_year": lunar.getYearInGanZhi(),
-        "ganzhi_month": lunar.getMonthInGanZhi(),
-        "ganzhi_day": lunar.getDayInGanZhi(),
-        "shengxiao": lunar.getYearShengXiao(),
+        "word": db_word,
+        "psychology": db_psychology,
+        "lunar": get_lunar(today),
     }
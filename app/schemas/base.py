@@ -1,4 +1,4 @@
-from datetime import datetime, timezone
+from datetime import datetime, timezone, date
 
 from pydantic import BaseModel, validator
 
@@ -27,4 +27,8 @@ class Lunar(BaseModel):
     ganzhi_year: str
     ganzhi_month: str
     ganzhi_day: str
-    shengxiao: str
\ No newline at end of file
+    shengxiao: str
+
+
+class LunarDay(Lunar):
+    solar: date
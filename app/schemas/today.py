@@ -0,0 +1,14 @@
+# Today schemas
+from typing import Optional
+
+from pydantic import BaseModel
+
+from .base import Lunar
+from .psychology import Psychology
+from .word import Word
+
+
+class Today(BaseModel):
+    word: Optional[Word]
+    psychology: Optional[Psychology]
+    lunar: Lunar
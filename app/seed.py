@@ -0,0 +1,181 @@
+"""
+Synthetic data seeder
+
+`manage.py seed` generates users, words and psychologies and inserts them
+in chunks with Core executemany, one transaction per table, or COPY on
+postgres. Seeded users share one bcrypt hash, so millions of rows take
+seconds instead of a commit, a refresh and a hash per row of crud create.
+"""
+import csv
+import io
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Any, Iterable, Iterator, List
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.engine import Engine, Connection
+from sqlalchemy.sql.schema import Table
+
+from app import crud
+from app.models.psychology import Psychology
+from app.models.user import User
+from app.models.word import Word
+from app.schemas.psychology import PsychologyClassifyEnum
+from app.utils import get_hashed_password
+
+CHUNK_SIZE = 10000
+
+FIRST_NAMES = (
+    "James", "Mary", "Wei", "Fang", "Li", "Na", "Robert", "Linda", "Jun", "Min",
+    "David", "Emma", "Lei", "Jing", "Daniel", "Olivia", "Tao", "Yan", "Lucas", "Mia",
+)
+LAST_NAMES = (
+    "Smith", "Wang", "Li", "Zhang", "Johnson", "Liu", "Chen", "Brown", "Yang",
+    "Zhao", "Miller", "Huang", "Zhou", "Davis", "Wu", "Xu", "Garcia", "Sun",
+)
+SYLLABLES = (
+    "ab", "ac", "ad", "al", "an", "ble", "con", "de", "dis", "er", "ex", "ful",
+    "im", "in", "ing", "ion", "ive", "ly", "ment", "ness", "or", "pre", "pro",
+    "re", "sion", "sub", "ter", "tion", "un", "ver",
+)
+PARTS_OF_SPEECH = ("n.", "v.", "adj.", "adv.", "vt.", "vi.")
+GLOSSES = (
+    "能力", "影响", "发展", "表达", "方法", "理论", "经验", "环境", "记忆", "注意",
+    "学习", "动机", "情绪", "认知", "行为", "感觉", "知觉", "思维", "人格", "态度",
+)
+TERMS = (
+    "注意", "记忆", "知觉", "思维", "动机", "情绪", "人格", "智力", "学习", "迁移",
+    "强化", "条件反射", "认知", "发展", "态度", "从众", "信度", "效度", "样本", "假设",
+)
+
+
+def seed_email(n: int) -> str:
+    """email of the nth seeded user"""
+    return f"user{n}@example.com"
+
+
+def seed(
+    engine: Engine, *, users: int = 0, words: int = 0, psychologies: int = 0,
+    password: str = "123456", confirm_ratio: float = 0.9, reset_cache: bool = True,
+) -> Dict[str, int]:
+    """
+    append generated rows to the tables of engine,
+    seeded rows continue from the last id so emails and word origins are unique
+    :param password: password of every seeded user
+    :param confirm_ratio: ratio of confirmed users
+    :param reset_cache: drop the redis counters and id pools of the tables
+    :return: rows inserted by table
+    """
+    # bcrypt is slow on purpose, hash once
+    hashed_password = get_hashed_password(password)
+    generators = (
+        (User, users, lambda start: _users(start, users, hashed_password, confirm_ratio)),
+        (Word, words, lambda start: _words(start, words)),
+        (Psychology, psychologies, lambda start: _psychologies(psychologies)),
+    )
+
+    inserted = {}
+    for model, count, rows in generators:
+        if not count:
+            continue
+        with engine.begin() as conn:
+            start = conn.execute(select(func.max(model.id))).scalar() or 0
+            insert_rows(conn, model.__table__, rows(start + 1))
+        inserted[model.__tablename__] = count
+
+    if reset_cache:
+        # counters and id pools are rebuilt on next read
+        for crud_model in (crud.user, crud.word, crud.psychology):
+            crud_model.reset_cache()
+    return inserted
+
+
+def insert_rows(conn: Connection, table: Table, rows: Iterable[Dict[str, Any]]) -> None:
+    """insert rows in chunks, by COPY on postgres or executemany"""
+    copy = conn.dialect.name == "postgresql"
+    for chunk in _chunks(rows, CHUNK_SIZE):
+        if copy:
+            _copy(conn, table, chunk)
+        else:
+            conn.execute(insert(table), chunk)
+
+
+def _copy(conn: Connection, table: Table, rows: List[Dict[str, Any]]) -> None:
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(
+            f'COPY "{table.name}" ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)',
+            buffer,
+        )
+    finally:
+        cursor.close()
+
+
+def _chunks(rows: Iterable[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _timestamp() -> str:
+    # a moment of the past year
+    moment = datetime.now() - timedelta(seconds=random.randrange(60 * 60 * 24 * 365))
+    return moment.isoformat()
+
+
+def _users(
+    start: int, count: int, hashed_password: str, confirm_ratio: float
+) -> Iterator[Dict[str, Any]]:
+    for n in range(start, start + count):
+        created_at = _timestamp()
+        yield {
+            "full_name": f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}",
+            "email": seed_email(n),
+            "hashed_password": hashed_password,
+            "is_active": True,
+            "is_superuser": False,
+            "is_confirm": random.random() < confirm_ratio,
+            "created_at": created_at,
+            "updated_at": created_at,
+        }
+
+
+def _words(start: int, count: int) -> Iterator[Dict[str, Any]]:
+    for n in range(start, start + count):
+        word = "".join(random.choices(SYLLABLES, k=random.randint(2, 4)))
+        created_at = _timestamp()
+        yield {
+            # the id suffix keeps origin unique
+            "origin": f"{word}{n}",
+            "pronunciation": f"/{word}/",
+            "translation": "；".join(
+                f"{random.choice(PARTS_OF_SPEECH)} {random.choice(GLOSSES)}"
+                for _ in range(random.randint(1, 3))
+            ),
+            "created_at": created_at,
+            "updated_at": created_at,
+        }
+
+
+def _psychologies(count: int) -> Iterator[Dict[str, Any]]:
+    classifies = [classify.value for classify in PsychologyClassifyEnum]
+    for _ in range(count):
+        created_at = _timestamp()
+        yield {
+            "classify": random.choice(classifies),
+            "knowledge": "，".join(random.choices(TERMS, k=random.randint(10, 40))) + "。",
+            "created_at": created_at,
+            "updated_at": created_at,
+        }
@@ -0,0 +1,75 @@
+"""
+Production server
+
+`manage.py run --prod` runs gunicorn with uvicorn workers on uvloop and
+httptools. The app is imported once in the master before the workers are
+forked, so they share its memory copy-on-write, e.g. the lunar table.
+
+Restart the workers gracefully with `kill -HUP <master pid>`. New workers
+are started before the old ones stop, the old ones finish their requests
+in GRACEFUL_TIMEOUT seconds. A preloaded app is not imported again on
+HUP, deploy new code with USR2 (a new master) and then TERM the old master.
+"""
+import multiprocessing
+from typing import Any, Dict
+
+from gunicorn.app.base import BaseApplication
+from loguru import logger
+
+from app.config import settings
+
+
+def post_fork(server, worker) -> None:
+    # connections opened by the master while importing must not be shared
+    from app.database import engine, replicas
+
+    engine.dispose()
+    for replica in replicas.engines:
+        replica.dispose()
+
+
+class Server(BaseApplication):
+    """gunicorn running the preloaded app"""
+
+    def __init__(self, options: Dict[str, Any]):
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app.main import app
+
+        return app
+
+
+def worker_count() -> int:
+    """WORKERS, or the cpu count if it is 0, one worker with the memory cache"""
+    if settings.CACHE_BACKEND == "memory":
+        # every worker would have its own daily rows, counters and pools
+        if settings.WORKERS > 1:
+            logger.warning("CACHE_BACKEND=memory runs one worker, WORKERS is ignored")
+        return 1
+    return settings.WORKERS or multiprocessing.cpu_count()
+
+
+def run_server(host: str, port: int, workers: int, log_level: str) -> None:
+    Server(
+        {
+            "bind": f"{host}:{port}",
+            "workers": workers,
+            # uvloop and httptools
+            "worker_class": "uvicorn.workers.UvicornWorker",
+            "preload_app": True,
+            "post_fork": post_fork,
+            "keepalive": settings.KEEP_ALIVE,
+            "backlog": settings.BACKLOG,
+            "graceful_timeout": settings.GRACEFUL_TIMEOUT,
+            "max_requests": settings.MAX_REQUESTS,
+            "max_requests_jitter": settings.MAX_REQUESTS // 10,
+            "loglevel": log_level,
+            "accesslog": "-",
+        }
+    ).run()
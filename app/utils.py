@@ -1,14 +1,19 @@
 import os
-from datetime import timedelta, datetime
-from typing import Union, Any, Optional
+from datetime import timedelta, datetime, time
+from functools import lru_cache, cached_property
+from typing import Union, Any, Optional, Dict, Tuple, TYPE_CHECKING
 
-import bcrypt
-import emails
-from emails.template import JinjaTemplate as T
-from jose import jwt
 from loguru import logger
 
 from app.config import settings
+from app.metrics import timer
+
+# emails (lxml, premailer, cssutils), jinja2, jose and bcrypt are slow to
+# import, they are imported on first use to keep worker boot and cli fast
+if TYPE_CHECKING:
+    import jinja2
+    from emails.backend.smtp import SMTPBackend
+    from emails.template import JinjaTemplate as T
 
 
 # security
@@ -33,6 +38,8 @@ def create_access_token(
     if is_superuser:
         to_encode.pop("exp")
 
+    from jose import jwt
+
     encoded_jwt = jwt.encode(
         to_encode, settings.SECRET_KEY, algorithm=settings.TOKEN_ALGORITHMS
     )
@@ -40,88 +47,159 @@ def create_access_token(
 
 
 def get_hashed_password(password: str) -> str:
-    return bcrypt.hashpw(password, bcrypt.gensalt())
+    import bcrypt
+
+    with timer("dependency_duration_seconds", dependency="bcrypt"):
+        return bcrypt.hashpw(password, bcrypt.gensalt())
 
 
 def verify_password(origin_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(origin_password, hashed_password)
+    import bcrypt
+
+    with timer("dependency_duration_seconds", dependency="bcrypt"):
+        return bcrypt.checkpw(origin_password, hashed_password)
 
 
 # email
 
 
+class EmailTemplates:
+    """
+    email templates of a dir, read and compiled once,
+    changed files are reloaded if EMAIL_TEMPLATES_RELOAD
+    """
+
+    def __init__(self, templates_dir: str):
+        self.templates_dir = templates_dir
+        # template name: (file mtime, compiled template)
+        self._templates: Dict[str, Tuple[float, "T"]] = {}
+
+    @cached_property
+    def environment(self) -> "jinja2.Environment":
+        import jinja2
+
+        return jinja2.Environment()
+
+    def load(self) -> None:
+        """load every html template, called at startup"""
+        for name in os.listdir(self.templates_dir):
+            if name.endswith(".html"):
+                self._load(name)
+
+    def get(self, name: str) -> "T":
+        entry = self._templates.get(name)
+        if entry is None or (
+            settings.EMAIL_TEMPLATES_RELOAD
+            and os.path.getmtime(os.path.join(self.templates_dir, name)) != entry[0]
+        ):
+            entry = self._load(name)
+        return entry[1]
+
+    def _load(self, name: str) -> Tuple[float, "T"]:
+        from emails.template import JinjaTemplate as T
+
+        path = os.path.join(self.templates_dir, name)
+        with open(path) as f:
+            template = T(f.read(), environment=self.environment)
+        # compile now instead of on first render
+        template.template
+        self._templates[name] = (os.path.getmtime(path), template)
+        return self._templates[name]
+
+
+email_templates = EmailTemplates(
+    os.path.join(os.path.abspath(os.path.dirname(__file__)), settings.EMAIL_TEMPLATES_DIR)
+)
+
+
+@lru_cache()
+def _subject_template(subject: str) -> "T":
+    from emails.template import JinjaTemplate as T
+
+    return T(subject, environment=email_templates.environment)
+
+
+def get_smtp_options() -> Dict[str, Any]:
+    """smtp server options"""
+    smtp_options = {"host": settings.SMTP_HOST, "port": settings.SMTP_PORT}
+    if settings.SMTP_SSL:
+        smtp_options["ssl"] = True
+    if settings.SMTP_USER:
+        smtp_options["user"] = settings.SMTP_USER
+    if settings.SMTP_PASSWORD:
+        smtp_options["password"] = settings.SMTP_PASSWORD
+    return smtp_options
+
+
 def send_email(
         email_to: str,
         subject_template: str = "",
-        html_template: str = "",
+        html_template: Union[str, "T"] = "",
         environment=None,
-) -> None:
+        smtp: "SMTPBackend" = None,
+) -> bool:
     """
     send email to some mail address
     :param email_to: send to this email
     :param subject_template: email subject
-    :param html_template: email content
+    :param html_template: email content, or compiled template
     :param environment: template params
-    :return: email send response
+    :param smtp: smtp backend keeping its connection, default a new connection
+    :return: whether sent
     """
+    import emails
+    from emails.template import JinjaTemplate as T
+
     if environment is None:
         environment = {}
 
     assert settings.EMAILS_ENABLED, "no provided configuration for email variables"
 
     # email message
+    if not isinstance(html_template, T):
+        html_template = T(html_template, environment=email_templates.environment)
     message = emails.Message(
-        subject=T(subject_template),
-        html=T(html_template),
+        subject=_subject_template(subject_template),
+        html=html_template,
         mail_from=(settings.EMAILS_FROM_NAME, settings.EMAILS_FROM_EMAIL),
     )
 
-    # smtp server
-    smtp_options = {"host": settings.SMTP_HOST, "port": settings.SMTP_PORT}
-    if settings.SMTP_SSL:
-        smtp_options["ssl"] = True
-    if settings.SMTP_USER:
-        smtp_options["user"] = settings.SMTP_USER
-    if settings.SMTP_PASSWORD:
-        smtp_options["password"] = settings.SMTP_PASSWORD
-
     # send
-    response = message.send(to=email_to, render=environment, smtp=smtp_options)
+    response = message.send(
+        to=email_to, render=environment, smtp=smtp or get_smtp_options()
+    )
 
     if response.status_code not in [
         250,
     ]:
         logger.info(f"send email failed {response}")
+        return False
 
     else:
         logger.info(f"send email to {email_to} successfully")
+        return True
 
 
-def send_test_email(email_to: str) -> None:
+def send_test_email(email_to: str, smtp: "SMTPBackend" = None) -> bool:
     subject = f"{settings.PROJECT_NAME} - Test email"
-    here = os.path.abspath(os.path.dirname(__file__))
-    with open(os.path.join(here, settings.EMAIL_TEMPLATES_DIR, "test_email.html")) as f:
-        template = f.read()
-    send_email(
+    template = email_templates.get("test_email.html")
+    return send_email(
         email_to,
         subject,
         template,
         {"project_name": settings.PROJECT_NAME, "email": email_to},
+        smtp=smtp,
     )
 
 
-def send_confirm_email(email_to: str, token: str) -> None:
+def send_confirm_email(email_to: str, token: str, smtp: "SMTPBackend" = None) -> bool:
     """send email verify user"""
     subject = f"{settings.PROJECT_NAME} - Verification link"
-    here = os.path.abspath(os.path.dirname(__file__))
-    with open(
-            os.path.join(here, settings.EMAIL_TEMPLATES_DIR, "verify_user.html")
-    ) as f:
-        content = f.read()
+    content = email_templates.get("verify_user.html")
 
     link = f"{settings.SERVER_HOST}{settings.API_V1_STR}/confirm?token={token}"
 
-    send_email(
+    return send_email(
         email_to=email_to,
         subject_template=subject,
         html_template=content,
@@ -130,24 +208,22 @@ def send_confirm_email(email_to: str, token: str) -> None:
             "email": email_to,
             "link": link,
         },
+        smtp=smtp,
     )
 
 
-def send_reset_password_email(email_to: str, token: str) -> None:
+def send_reset_password_email(
+        email_to: str, token: str, smtp: "SMTPBackend" = None
+) -> bool:
     """send email to user for reset password"""
     subject = f"{settings.PROJECT_NAME} - Password Reset"
-    here = os.path.abspath(os.path.dirname(__file__))
-
-    with open(
-            os.path.join(here, settings.EMAIL_TEMPLATES_DIR, "reset_password.html")
-    ) as f:
-        content = f.read()
+    content = email_templates.get("reset_password.html")
 
     link = (
         f"{settings.SERVER_HOST}{settings.API_V1_STR}/me/confirm-password?token={token}"
     )
 
-    send_email(
+    return send_email(
         email_to=email_to,
         subject_template=subject,
         html_template=content,
@@ -156,12 +232,25 @@ def send_reset_password_email(email_to: str, token: str) -> None:
             "email": email_to,
             "link": link,
         },
+        smtp=smtp,
     )
 
 
 def verify_confirm_token(token: str) -> Optional[str]:
+    from jose import jwt
+
     try:
         decoded_token = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
         return decoded_token["sub"]
     except jwt.JWTError:
         return None
+
+
+# date
+
+
+def seconds_until_midnight(now: datetime = None) -> int:
+    now = now or datetime.now()
+    midnight = datetime.combine(now.date() + timedelta(days=1), time.min)
+    return int((midnight - now).total_seconds())
+
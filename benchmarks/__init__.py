@@ -0,0 +1,8 @@
+"""
+Benchmarks of the hot endpoints
+
+`manage.py bench` seeds a dataset into a bench database, starts the api
+on it in a subprocess and drives the scenarios concurrently over http,
+the latency percentiles and throughput are reported as json and compared
+with a stored baseline.
+"""
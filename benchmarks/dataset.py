@@ -0,0 +1,26 @@
+"""seed a bench database with users, words and psychologies"""
+from sqlalchemy import create_engine
+
+from app.database import Base
+from app.seed import seed as seed_rows
+
+BENCH_PASSWORD = "bench123456"
+
+
+def seed(uri: str, *, users: int, words: int, psychologies: int) -> None:
+    """drop and fill the bench database, every bench user is confirmed"""
+    engine = create_engine(uri)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+    # the bench redis db is flushed by the bench server instead
+    seed_rows(
+        engine,
+        users=users,
+        words=words,
+        psychologies=psychologies,
+        password=BENCH_PASSWORD,
+        confirm_ratio=1,
+        reset_cache=False,
+    )
+    engine.dispose()
@@ -0,0 +1,143 @@
+"""run the scenarios against a bench server and compare with a baseline"""
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Any, Iterator
+
+import redis
+import requests
+
+from app.config import settings
+from benchmarks.scenarios import Client, SCENARIOS
+
+
+@contextmanager
+def bench_server(
+    uri: str, port: int, redis_db: str, workers: int = 1
+) -> Iterator[str]:
+    """run the api on the bench database and redis db, yield its base url"""
+    if workers > 1 and settings.CACHE_BACKEND == "memory":
+        raise ValueError("CACHE_BACKEND=memory runs one worker")
+    # the bench redis db starts empty, no counters or pools of other data
+    if settings.CACHE_BACKEND == "redis":
+        redis.Redis(
+            host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=redis_db
+        ).flushdb()
+
+    env = dict(
+        os.environ,
+        SOUL_API_DATABASE_URI=uri,
+        SOUL_API_REDIS_DB=redis_db,
+        SOUL_API_SQL_QUERY_HEADERS="false",
+        # every bench client logs in from the same ip at full speed
+        SOUL_API_RATE_LIMITS="{}",
+        SOUL_API_ADMISSION_ENABLED="false",
+    )
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "app.main:app",
+            "--port", str(port), "--workers", str(workers), "--log-level", "warning",
+        ],
+        env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        _wait_ready(base_url, process)
+        yield base_url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def _wait_ready(base_url: str, process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("bench server exited")
+        try:
+            requests.get(base_url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f"bench server not ready in {timeout}s")
+
+
+def percentile(latencies: List[float], p: float) -> float:
+    """nearest rank percentile of sorted latencies"""
+    if not latencies:
+        return 0.0
+    return latencies[max(math.ceil(p / 100 * len(latencies)) - 1, 0)]
+
+
+def run_scenario(
+    name: str, base_url: str, dataset: Dict[str, int], concurrency: int, duration: float
+) -> Dict[str, Any]:
+    """call a scenario from concurrency threads for duration seconds"""
+    scenario = SCENARIOS[name]
+    clients = [Client(base_url, **dataset) for _ in range(concurrency)]
+    latencies: List[List[float]] = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    window = {}
+
+    def begin() -> None:
+        # run by the barrier once every thread is warm, before any is released
+        window["start"] = time.perf_counter()
+        window["deadline"] = window["start"] + duration
+
+    barrier = threading.Barrier(concurrency + 1, action=begin)
+
+    def work(index: int) -> None:
+        client = clients[index]
+        # one untimed call warms the connection
+        scenario(client)
+        barrier.wait()
+        while time.perf_counter() < window["deadline"]:
+            start = time.perf_counter()
+            try:
+                scenario(client)
+            except requests.RequestException:
+                errors[index] += 1
+                continue
+            latencies[index].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - window["start"]
+
+    merged = sorted(latency for thread_latencies in latencies for latency in thread_latencies)
+    return {
+        "requests": len(merged),
+        "errors": sum(errors),
+        "throughput": round(len(merged) / elapsed, 2),
+        "p50_ms": round(percentile(merged, 50) * 1000, 2),
+        "p95_ms": round(percentile(merged, 95) * 1000, 2),
+        "p99_ms": round(percentile(merged, 99) * 1000, 2),
+    }
+
+
+def compare(
+    report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """regressions of a report over a baseline, p95 or throughput worse than tolerance"""
+    regressions = []
+    for name, result in report["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 {result['p95_ms']}ms, baseline {base['p95_ms']}ms"
+            )
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {result['throughput']}/s, baseline {base['throughput']}/s"
+            )
+    return regressions
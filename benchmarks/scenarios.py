@@ -0,0 +1,75 @@
+"""the hot paths driven by the bench, one request each call"""
+import random
+from typing import Callable, Dict
+
+import requests
+
+from app.config import settings
+from app.seed import seed_email
+from benchmarks.dataset import BENCH_PASSWORD
+
+
+class Client:
+    """a http session of one bench thread, logged in as a random bench user"""
+
+    def __init__(self, base_url: str, users: int, words: int, psychologies: int):
+        self.base_url = base_url + settings.API_V1_STR
+        self.users = users
+        self.words = words
+        self.psychologies = psychologies
+        self.session = requests.Session()
+        token = self.login()
+        self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def login(self) -> str:
+        rsp = self.session.post(
+            f"{self.base_url}/login",
+            data={
+                "username": seed_email(random.randint(1, self.users)),
+                "password": BENCH_PASSWORD,
+            },
+        )
+        rsp.raise_for_status()
+        return rsp.json()["access_token"]
+
+    def get(self, path: str, **params) -> None:
+        rsp = self.session.get(f"{self.base_url}{path}", params=params)
+        rsp.raise_for_status()
+
+
+def login(client: Client) -> None:
+    client.login()
+
+
+def word_daily(client: Client) -> None:
+    client.get("/words/daily")
+
+
+def psychology_random(client: Client) -> None:
+    client.get("/psychologies/random")
+
+
+def psychology_list(client: Client) -> None:
+    page = random.randrange(max(client.psychologies // 20, 1))
+    client.get("/psychologies/", skip=page * 20, limit=20)
+
+
+def psychology_by_id(client: Client) -> None:
+    client.get(f"/psychologies/{random.randint(1, client.psychologies)}")
+
+
+def word_by_id(client: Client) -> None:
+    client.get(f"/words/{random.randint(1, client.words)}")
+
+
+SCENARIOS: Dict[str, Callable[[Client], None]] = {
+    scenario.__name__: scenario
+    for scenario in (
+        login,
+        word_daily,
+        psychology_random,
+        psychology_list,
+        psychology_by_id,
+        word_by_id,
+    )
+}
@@ -1,3 +1,8 @@
+import json
+import os
+import time
+from typing import List, Optional
+
 import typer
 import uvicorn
 from alembic.config import Config
@@ -5,7 +10,9 @@ from alembic.config import Config
 import alembic
 from app import crud, schemas
 from app.config import settings
-from app.database import SessionLocal, init_db
+from app.database import SessionLocal, engine, init_db
+from app.importtime import measure_import
+from app.lunar import build_lunar_table, table_path
 
 app = typer.Typer()
 
@@ -16,7 +23,22 @@ def run(
     port: int = typer.Option(8000, help="server port"),
     log_level: str = typer.Option("info", "--log-level", help="log level"),
     reload: bool = typer.Option(True, help="whether auto reload"),
+    prod: bool = typer.Option(
+        False, help="production mode, gunicorn with uvicorn workers and no reload"
+    ),
+    workers: Optional[int] = typer.Option(
+        None, help="production worker processes, default WORKERS or the cpu count"
+    ),
 ):
+    if prod:
+        from app.server import run_server, worker_count
+
+        if workers and workers > 1 and settings.CACHE_BACKEND == "memory":
+            typer.echo("CACHE_BACKEND=memory runs one worker, use redis for more")
+            raise typer.Exit(1)
+        run_server(host, port, workers or worker_count(), log_level)
+        return
+
     uvicorn.run(
         "app.main:app", host=host, port=port, log_level=log_level, reload=reload
     )
@@ -53,6 +75,102 @@ def createsuperuser(
     typer.echo("superuser created.")
 
 
+@app.command(help="exact recount the list counters")
+def recount():
+    db = SessionLocal()
+    for crud_model in (crud.user, crud.psychology, crud.word):
+        counters = crud_model.recount(db)
+        typer.echo(f"{crud_model.count_key}: {counters}")
+
+
+@app.command(help="insert generated users, words and psychologies in bulk")
+def seed(
+    users: int = typer.Option(0, help="users inserted"),
+    words: int = typer.Option(0, help="words inserted"),
+    psychologies: int = typer.Option(0, help="psychologies inserted"),
+    password: str = typer.Option("123456", help="password of every seeded user"),
+):
+    from app.seed import seed as seed_rows
+
+    start = time.perf_counter()
+    inserted = seed_rows(
+        engine, users=users, words=words, psychologies=psychologies, password=password
+    )
+    typer.echo(f"seeded {inserted} in {time.perf_counter() - start:.1f}s")
+
+
+@app.command(help="benchmark the hot endpoints on a seeded bench database")
+def bench(
+    database_uri: str = typer.Option("sqlite:///./bench.db", help="bench database url"),
+    redis_db: str = typer.Option("15", help="bench redis db, flushed before run"),
+    users: int = typer.Option(10000, help="users seeded"),
+    words: int = typer.Option(100000, help="words seeded"),
+    psychologies: int = typer.Option(300000, help="psychologies seeded"),
+    seed: bool = typer.Option(True, help="seed the bench database first"),
+    scenario: Optional[List[str]] = typer.Option(
+        None, help="scenarios run, default all of benchmarks/scenarios.py"
+    ),
+    concurrency: int = typer.Option(16, help="concurrent clients"),
+    duration: float = typer.Option(10, help="seconds every scenario runs"),
+    port: int = typer.Option(8765, help="bench server port"),
+    workers: int = typer.Option(1, help="bench server workers"),
+    output: Optional[str] = typer.Option(None, help="write the report json to"),
+    baseline: str = typer.Option("benchmarks/baseline.json", help="baseline report"),
+    save_baseline: bool = typer.Option(False, help="save the report as baseline"),
+    tolerance: float = typer.Option(0.2, help="regression allowed over the baseline"),
+):
+    # the bench client needs requests, imported by this command only
+    from benchmarks.dataset import seed as seed_bench
+    from benchmarks.runner import bench_server, run_scenario, compare
+    from benchmarks.scenarios import SCENARIOS
+
+    dataset = {"users": users, "words": words, "psychologies": psychologies}
+    if seed:
+        typer.echo(f"seeding {dataset} to {database_uri}")
+        seed_bench(database_uri, **dataset)
+
+    report = {"dataset": dataset, "concurrency": concurrency, "scenarios": {}}
+    with bench_server(database_uri, port, redis_db, workers) as base_url:
+        for name in scenario or SCENARIOS:
+            result = run_scenario(name, base_url, dataset, concurrency, duration)
+            report["scenarios"][name] = result
+            typer.echo(f"{name}: {result}")
+
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+    typer.echo(text)
+
+    if save_baseline:
+        with open(baseline, "w") as f:
+            f.write(text)
+        typer.echo(f"saved baseline to {baseline}")
+    elif os.path.exists(baseline):
+        with open(baseline) as f:
+            regressions = compare(report, json.load(f), tolerance)
+        for regression in regressions:
+            typer.echo(f"regression {regression}", err=True)
+        if regressions:
+            raise typer.Exit(1)
+
+
+@app.command("startup-profile", help="report the cold import time of a module")
+def startup_profile(
+    module: str = typer.Option("app.main", help="module imported"),
+    top: int = typer.Option(20, help="slowest modules listed"),
+):
+    wall, times = measure_import(module)
+    typer.echo(f"import {module}: {wall * 1000:.0f}ms")
+
+    typer.echo(f"\n{'cumulative':>12} {'self':>10}  module")
+    for item in sorted(times, key=lambda t: t.cumulative_us, reverse=True)[:top]:
+        typer.echo(
+            f"{item.cumulative_us / 1000:10.1f}ms {item.self_us / 1000:8.1f}ms  "
+            f"{'  ' * item.depth}{item.module}"
+        )
+
+
 # db command
 
 db_app = typer.Typer()
@@ -83,5 +201,72 @@ def db_upgrade():
 
 app.add_typer(db_app, name="db")
 
+# worker command
+
+worker_app = typer.Typer()
+
+
+@worker_app.command("emails", help="send emails from the outbox")
+def worker_emails(
+    concurrency: int = typer.Option(
+        settings.EMAILS_WORKER_CONCURRENCY, help="emails sent at the same time"
+    ),
+):
+    from app.outbox import run_email_worker
+
+    if settings.CACHE_BACKEND == "memory":
+        # the outbox is in redis, the api sends emails itself without it
+        typer.echo("the email worker needs CACHE_BACKEND=redis")
+        raise typer.Exit(1)
+    run_email_worker(concurrency)
+
+
+app.add_typer(worker_app, name="worker")
+
+# digest command
+
+digest_app = typer.Typer()
+
+
+@digest_app.command("send", help="send today's digest to all confirmed users")
+def digest_send(
+    batch_size: int = typer.Option(settings.DIGEST_BATCH_SIZE, help="users per batch"),
+    concurrency: int = typer.Option(
+        settings.DIGEST_CONCURRENCY, help="digests sent at the same time"
+    ),
+    rate: float = typer.Option(
+        settings.DIGEST_RATE_LIMIT, help="digests per second at most, 0 unlimited"
+    ),
+    restart: bool = typer.Option(False, help="ignore today's progress"),
+):
+    from app.digest import send_digest
+
+    db = SessionLocal()
+    sent, failed = send_digest(
+        db, batch_size=batch_size, concurrency=concurrency, rate=rate, restart=restart
+    )
+    typer.echo(f"digest sent {sent}, failed {failed}")
+
+
+app.add_typer(digest_app, name="digest")
+
+# lunar command
+
+lunar_app = typer.Typer()
+
+
+@lunar_app.command("build", help="precompute the lunar table")
+def lunar_build(
+    start: int = typer.Option(settings.LUNAR_TABLE_START, help="first year"),
+    end: int = typer.Option(settings.LUNAR_TABLE_END, help="last year"),
+    processes: int = typer.Option(None, help="build processes, default cpu count"),
+):
+    path = table_path()
+    days = build_lunar_table(start, end, path, processes=processes)
+    typer.echo(f"built lunar table of {days} days to {path}")
+
+
+app.add_typer(lunar_app, name="lunar")
+
 if __name__ == "__main__":
     app()
@@ -8,6 +8,7 @@ from fastapi.testclient import TestClient
 from lunar_python import Lunar
 from sqlalchemy.orm import Session
 
+from app import crud
 from app.config import settings
 from app.schemas import PsychologyClassifyEnum
 from tests.utils import (
@@ -103,6 +104,26 @@ class TestLogin:
         assert rsp.status_code == 400
         assert "exists" in rsp.json()["detail"]
 
+    def test_login_rate_limited(self, monkeypatch):
+        from app import depends
+        from app.cache import MemoryRedis
+        from app.ratelimit import RateLimiter
+
+        monkeypatch.setattr(depends, "rate_limiter", RateLimiter(MemoryRedis()))
+        monkeypatch.setitem(settings.RATE_LIMITS, "login", {"requests": 2, "seconds": 60})
+        login_data = {
+            "username": settings.SUPERUSER_EMAIL,
+            "password": settings.SUPERUSER_PASSWORD,
+        }
+        for _ in range(2):
+            rsp = self.client.post(f"{settings.API_V1_STR}/login", data=login_data)
+            assert rsp.status_code == 200
+
+        rsp = self.client.post(f"{settings.API_V1_STR}/login", data=login_data)
+        assert rsp.status_code == 429
+        # a token every 30 seconds
+        assert 0 < int(rsp.headers["Retry-After"]) <= 30
+
 
 class TestEmail:
     @pytest.fixture(autouse=True)
@@ -158,6 +179,104 @@ class TestPsychology:
     def test_read_psychology_multi(self):
         rsp = self.client.get(f"{settings.API_V1_STR}/psychologies")
 
+    def test_read_psychology_multi_total_count(self):
+        create_random_psychologies(self.db, self.fake)
+
+        headers = {"Authorization": f"Bearer {self.get_superuser_token}"}
+        rsp = self.client.get(f"{settings.API_V1_STR}/psychologies/", headers=headers)
+
+        assert rsp.status_code == 200
+        assert int(rsp.headers["X-Total-Count"]) == crud.psychology.count_exact(self.db)
+
+    def test_read_psychology_multi_by_classify(self):
+        random_psy = create_random_psychologies(self.db, self.fake)
+
+        headers = {"Authorization": f"Bearer {self.get_superuser_token}"}
+        # read every page, the new row is in one of them whatever the table size
+        ids, skip = [], 0
+        while True:
+            rsp = self.client.get(
+                f"{settings.API_V1_STR}/psychologies/"
+                f"?classify={random_psy.classify}&skip={skip}&limit=100",
+                headers=headers,
+            )
+            assert rsp.status_code == 200
+            if not rsp.json():
+                break
+            assert all(psy["classify"] == random_psy.classify for psy in rsp.json())
+            ids.extend(psy["id"] for psy in rsp.json())
+            skip += 100
+
+        assert random_psy.id in ids
+        assert int(rsp.headers["X-Total-Count"]) == crud.psychology.count_exact(
+            self.db, classify=random_psy.classify
+        )
+
+    def test_read_psychology_random_by_classify(self):
+        random_psy = create_random_psychologies(self.db, self.fake)
+
+        headers = {"Authorization": f"Bearer {self.get_superuser_token}"}
+        rsp = self.client.get(
+            f"{settings.API_V1_STR}/psychologies/random?classify={random_psy.classify}",
+            headers=headers,
+        )
+
+        assert rsp.status_code == 200
+        assert rsp.json()["classify"] == random_psy.classify
+
+    def test_read_psychology_random_unseen_weighted(self):
+        create_random_psychologies(self.db, self.fake)
+
+        headers = {"Authorization": f"Bearer {self.get_superuser_token}"}
+        rsp = self.client.get(
+            f"{settings.API_V1_STR}/psychologies/random?unseen=true&weighted=true",
+            headers=headers,
+        )
+
+        assert rsp.status_code == 200
+        assert rsp.json()["classify"] in [c.value for c in PsychologyClassifyEnum]
+
+    def test_read_psychology_random_count(self):
+        for _ in range(3):
+            create_random_psychologies(self.db, self.fake)
+
+        headers = {"Authorization": f"Bearer {self.get_superuser_token}"}
+        rsp = self.client.get(
+            f"{settings.API_V1_STR}/psychologies/random?count=3", headers=headers
+        )
+
+        assert rsp.status_code == 200
+        assert len(rsp.json()) == 3
+        assert len({psy["id"] for psy in rsp.json()}) == 3
+
+    def test_read_psychology_daily(self):
+        create_random_psychologies(self.db, self.fake)
+        headers = {"Authorization": f"Bearer {self.get_superuser_token}"}
+
+        # picked and saved, then read back from redis
+        first = self.client.get(f"{settings.API_V1_STR}/psychologies/daily", headers=headers)
+        second = self.client.get(f"{settings.API_V1_STR}/psychologies/daily", headers=headers)
+        assert first.status_code == second.status_code == 200
+        assert first.json() == second.json()
+
+    def test_read_psychology_daily_after_update(self):
+        create_random_psychologies(self.db, self.fake)
+        headers = {"Authorization": f"Bearer {self.get_superuser_token}"}
+        daily = self.client.get(f"{settings.API_V1_STR}/psychologies/daily", headers=headers)
+        pid = daily.json()["id"]
+
+        # the row of the day cached whole is dropped by the update
+        knowledge = self.fake.text()
+        rsp = self.client.put(
+            f"{settings.API_V1_STR}/psychologies/{pid}",
+            json={"knowledge": knowledge},
+            headers=headers,
+        )
+        assert rsp.status_code == 200
+        rsp = self.client.get(f"{settings.API_V1_STR}/psychologies/daily", headers=headers)
+        assert rsp.json()["id"] == pid
+        assert rsp.json()["knowledge"] == knowledge
+
     def test_read_psychology_by_id(self):
         random_psy = create_random_psychologies(self.db, self.fake)
 
@@ -218,3 +337,77 @@ class TestUtils:
         assert (
                 result["date"] == f"{lunar.getMonthInChinese()}月{lunar.getDayInChinese()}"
         )
+
+    def test_lunar_range(self):
+        headers = {"Authorization": f"Bearer {self.get_superuser_token}"}
+        rsp = self.client.get(
+            f"{settings.API_V1_STR}/utils/lunar?start=2021-02-01&end=2021-02-28",
+            headers=headers,
+        )
+        assert rsp.status_code == 200
+        result = rsp.json()
+
+        assert len(result) == 28
+        lunar = Lunar.fromDate(datetime(2021, 2, 12))
+        assert result[11]["solar"] == "2021-02-12"
+        assert result[11]["date"] == f"{lunar.getMonthInChinese()}月{lunar.getDayInChinese()}"
+
+    def test_today(self):
+        create_random_psychologies(self.db, self.fake)
+        headers = {"Authorization": f"Bearer {self.get_superuser_token}"}
+
+        rsp = self.client.get(f"{settings.API_V1_STR}/today", headers=headers)
+        assert rsp.status_code == 200
+        result = rsp.json()
+        assert result["psychology"]["id"]
+        assert result["lunar"]["date"]
+        assert "max-age" in rsp.headers["Cache-Control"]
+
+        headers["If-None-Match"] = rsp.headers["ETag"]
+        rsp = self.client.get(f"{settings.API_V1_STR}/today", headers=headers)
+        assert rsp.status_code == 304
+
+    def test_metrics(self):
+        headers = {"Authorization": f"Bearer {self.get_superuser_token}"}
+        self.client.get(f"{settings.API_V1_STR}/utils/lunar", headers=headers)
+
+        rsp = self.client.get("/metrics")
+        assert rsp.status_code == 200
+        assert (
+            'http_requests_total{method="GET",route="/api/v1/utils/lunar",status="200"}'
+            in rsp.text
+        )
+        assert 'dependency_duration_seconds_count{dependency="user_lookup"}' in rsp.text
+
+    def test_query_stats_headers(self, monkeypatch):
+        monkeypatch.setattr(settings, "SQL_QUERY_HEADERS", True)
+        headers = {"Authorization": f"Bearer {self.get_superuser_token}"}
+        rsp = self.client.get(f"{settings.API_V1_STR}/users/", headers=headers)
+        assert rsp.status_code == 200
+        # user lookup, count and list
+        assert int(rsp.headers["X-Query-Count"]) >= 2
+        assert float(rsp.headers["X-Query-Time"]) >= 0
+
+    def test_profile(self):
+        headers = {"Authorization": f"Bearer {self.get_superuser_token}"}
+        rsp = self.client.get(
+            f"{settings.API_V1_STR}/utils/profile?seconds=0.2", headers=headers
+        )
+        assert rsp.status_code == 200
+        stack, count = rsp.text.splitlines()[0].rsplit(" ", 1)
+        assert int(count) > 0
+        assert ";" in stack
+
+    def test_profile_request(self):
+        headers = {
+            "Authorization": f"Bearer {self.get_superuser_token}",
+            "X-Profile": "1",
+        }
+        rsp = self.client.get(f"{settings.API_V1_STR}/users/", headers=headers)
+        assert rsp.status_code == 200
+        profile_id = rsp.headers["X-Profile"]
+
+        rsp = self.client.get(
+            f"{settings.API_V1_STR}/utils/profile/{profile_id}", headers=headers
+        )
+        assert rsp.status_code == 200
@@ -0,0 +1,687 @@
+import os
+import random
+import time
+from collections import Counter
+from uuid import uuid4
+
+import pytest
+
+from app.config import settings
+from app.crud.psychology import AliasTable
+
+
+def test_alias_table_sample():
+    rng = random.Random(0)
+    weights = {"normal": 1, "society": 3, "measure": 0}
+    table = AliasTable(weights)
+
+    samples = Counter(table.sample(rng) for _ in range(20000))
+
+    assert "measure" not in samples
+    assert 2.7 < samples["society"] / samples["normal"] < 3.3
+
+    with pytest.raises(ValueError):
+        AliasTable({"normal": 0})
+
+
+def test_classify_weights_validated():
+    from pydantic import ValidationError
+
+    from app.config import Settings
+    from app.schemas.psychology import PsychologyClassifyEnum
+
+    assert Settings(PSYCHOLOGY_CLASSIFY_WEIGHTS={"normal": 0, "society": 3})
+    all_zero = {classify.value: 0 for classify in PsychologyClassifyEnum}
+    for weights in ({"unknown": 1}, {"normal": -1}, all_zero):
+        with pytest.raises(ValidationError):
+            Settings(PSYCHOLOGY_CLASSIFY_WEIGHTS=weights)
+
+
+@pytest.mark.skipif(
+    settings.CACHE_BACKEND == "memory", reason="the outbox needs a redis server"
+)
+def test_outbox_retry_then_dead(monkeypatch):
+    from app.database import RedisLocal
+    from app.outbox import process_email, RETRY_KEY, DEAD_KEY, _dumps
+
+    monkeypatch.setattr(settings, "EMAILS_ENABLED", False)
+    monkeypatch.setattr(settings, "EMAILS_MAX_ATTEMPTS", 2)
+    RedisLocal.delete(RETRY_KEY, DEAD_KEY)
+
+    # emails disabled, sending fails
+    raw = _dumps("send_test_email", {"email_to": "test@example.com"}, attempts=0)
+    assert not process_email(raw, smtp=None)
+    retry, = RedisLocal.zrange(RETRY_KEY, 0, -1)
+
+    assert not process_email(retry, smtp=None)
+    assert RedisLocal.llen(DEAD_KEY) == 1
+
+
+@pytest.mark.skipif(
+    settings.CACHE_BACKEND == "memory", reason="the outbox needs a redis server"
+)
+def test_outbox_requeue_orphans():
+    from app.database import RedisLocal
+    from app.outbox import OUTBOX_KEY, PROCESSING_KEY, HEARTBEAT_KEY, requeue_orphans
+
+    alive, dead = f"alive{uuid4().hex}", f"dead{uuid4().hex}"
+    RedisLocal.set(f"{HEARTBEAT_KEY}:{alive}", 1, ex=10)
+    RedisLocal.lpush(f"{PROCESSING_KEY}:{alive}:0", "sending")
+    RedisLocal.lpush(f"{PROCESSING_KEY}:{dead}:0", "lost")
+    outbox = RedisLocal.llen(OUTBOX_KEY)
+
+    assert requeue_orphans() == 1
+    assert RedisLocal.llen(OUTBOX_KEY) == outbox + 1
+    assert RedisLocal.llen(f"{PROCESSING_KEY}:{alive}:0") == 1
+
+    RedisLocal.delete(f"{HEARTBEAT_KEY}:{alive}", f"{PROCESSING_KEY}:{alive}:0")
+    RedisLocal.lrem(OUTBOX_KEY, 1, "lost")
+
+
+def test_email_templates_reload(tmp_path, monkeypatch):
+    from app.utils import EmailTemplates
+
+    path = tmp_path / "hello.html"
+    path.write_text("hello {{ name }}")
+    templates = EmailTemplates(str(tmp_path))
+    templates.load()
+    assert templates.get("hello.html").render(name="soul") == "hello soul"
+
+    path.write_text("hi {{ name }}")
+    os.utime(path, (0, 0))
+    assert templates.get("hello.html").render(name="soul") == "hello soul"
+
+    monkeypatch.setattr(settings, "EMAIL_TEMPLATES_RELOAD", True)
+    assert templates.get("hello.html").render(name="soul") == "hi soul"
+
+
+def test_query_stats_repeated(monkeypatch):
+    from app.queries import QueryStats
+
+    monkeypatch.setattr(settings, "SQL_REPEAT_THRESHOLD", 3)
+    stats = QueryStats(scope={})
+    stats.add("SELECT * FROM word WHERE id = ?", (1,), 0.001)
+    stats.add("SELECT * FROM word WHERE id = ?", (1,), 0.001)
+    stats.add("SELECT * FROM word WHERE id = ?", (2,), 0.001)
+
+    assert stats.count == 3
+    assert stats.repeated() == {("SELECT * FROM word WHERE id = ?", "(1,)"): 2}
+    assert stats.similar() == {"SELECT * FROM word WHERE id = ?": 3}
+
+
+def test_bench_percentile_and_compare():
+    from benchmarks.runner import percentile, compare
+
+    latencies = [i / 1000 for i in range(1, 101)]
+    assert percentile(latencies, 50) == 0.05
+    assert percentile(latencies, 99) == 0.099
+
+    baseline = {"scenarios": {"word_by_id": {"p95_ms": 10, "throughput": 100}}}
+    report = {"scenarios": {"word_by_id": {"p95_ms": 11, "throughput": 95}}}
+    assert compare(report, baseline, tolerance=0.2) == []
+    report["scenarios"]["word_by_id"]["p95_ms"] = 13
+    assert len(compare(report, baseline, tolerance=0.2)) == 1
+
+
+def test_seed_continues_ids():
+    from sqlalchemy import create_engine
+
+    from app.database import Base
+    from app.seed import seed
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    seed(engine, users=3, words=5, reset_cache=False)
+    inserted = seed(engine, users=2, psychologies=4, reset_cache=False)
+
+    assert inserted == {"user": 2, "psychology": 4}
+    emails = [row[0] for row in engine.execute("select email from user order by id")]
+    assert emails[-1] == "user5@example.com"
+    assert len(set(emails)) == 5
+
+
+def test_import_budget():
+    from app.importtime import measure_import
+
+    # imported on first use only
+    _, times = measure_import("app.main")
+    lazy = {"emails", "lxml", "premailer", "cssutils", "lunar_python", "jose", "bcrypt"}
+    assert not lazy & {item.module for item in times}
+
+    # imported by the commands using them
+    _, times = measure_import("manage")
+    lazy |= {"requests", "benchmarks", "app.digest", "app.outbox", "app.seed"}
+    assert not lazy & {item.module for item in times}
+
+
+def test_engine_profiles(tmp_path):
+    from sqlalchemy.pool import QueuePool
+
+    from app.database import engine_options, make_engine, pool_stats
+
+    options = engine_options("postgresql://soul@localhost/soul")
+    assert options["pool_size"] == settings.DB_POOL_SIZE
+    assert "connect_args" not in options
+    assert "pool_size" not in engine_options("sqlite://")
+
+    engine = make_engine(f"sqlite:///{tmp_path}/test.db", "test")
+    assert isinstance(engine.pool, QueuePool)
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+        assert pool_stats(engine)["checked_out"] == 1
+    assert pool_stats(engine)["checked_in"] == 1
+
+
+def test_routing_session_reads_replica_until_write(tmp_path):
+    from app.database import Base, ReplicaSet, RoutingSession, make_engine
+    from app.models.word import Word
+
+    primary = make_engine(f"sqlite:///{tmp_path}/primary.db", "test_primary")
+    replica = make_engine(f"sqlite:///{tmp_path}/replica.db", "test_replica")
+    for engine in (primary, replica):
+        Base.metadata.create_all(engine)
+    with replica.begin() as conn:
+        conn.execute(Word.__table__.insert(), [{"origin": "a"}, {"origin": "b"}])
+    replicas = ReplicaSet([replica])
+
+    db = RoutingSession(bind=primary, replicas=replicas)
+    db.read_only = True
+    assert db.query(Word).count() == 2
+
+    db.add(Word(origin="soul"))
+    db.commit()
+    assert db.wrote
+    # reads its own write from the primary
+    assert db.query(Word).count() == 1
+    db.close()
+
+    # all replicas down, read from the primary
+    replicas.mark_down(replica)
+    db = RoutingSession(bind=primary, replicas=replicas)
+    db.read_only = True
+    assert db.query(Word).count() == 1
+    db.close()
+
+
+def test_circuit_breaker():
+    import redis
+
+    from app.redis_client import CircuitBreaker, CircuitOpenError
+
+    calls = []
+
+    def down():
+        calls.append(1)
+        raise redis.ConnectionError("down")
+
+    breaker = CircuitBreaker(failures=2, reset=0.05)
+    for _ in range(2):
+        with pytest.raises(redis.ConnectionError):
+            breaker.call(down)
+    # open, fails without calling redis
+    with pytest.raises(CircuitOpenError):
+        breaker.call(down)
+    assert len(calls) == 2
+
+    time.sleep(0.06)
+    assert breaker.call(lambda: "up") == "up"
+    assert not breaker.is_open
+
+
+def test_circuit_breaker_closes_on_redis_reply():
+    import redis
+
+    from app.redis_client import CircuitBreaker
+
+    def down():
+        raise redis.ConnectionError("down")
+
+    def noscript():
+        raise redis.exceptions.NoScriptError("NOSCRIPT")
+
+    breaker = CircuitBreaker(failures=1, reset=0.01)
+    with pytest.raises(redis.ConnectionError):
+        breaker.call(down)
+    time.sleep(0.02)
+    # the trial command fails, but redis answered it
+    with pytest.raises(redis.exceptions.NoScriptError):
+        breaker.call(noscript)
+    assert not breaker.is_open
+    assert breaker.call(lambda: "up") == "up"
+
+
+def test_circuit_breaker_one_trial():
+    import threading
+
+    import redis
+
+    from app.redis_client import CircuitBreaker, CircuitOpenError
+
+    def down():
+        raise redis.ConnectionError("down")
+
+    in_flight_started, in_flight_done = threading.Event(), threading.Event()
+    trial_started, trial_done = threading.Event(), threading.Event()
+
+    def in_flight():
+        in_flight_started.set()
+        in_flight_done.wait(1)
+        raise ValueError("not a redis error")
+
+    def trial():
+        trial_started.set()
+        trial_done.wait(1)
+        return "up"
+
+    def send_in_flight():
+        with pytest.raises(ValueError):
+            breaker.call(in_flight)
+
+    breaker = CircuitBreaker(failures=1, reset=0.01)
+    # sent while the circuit is closed, it ends during the trial
+    sender = threading.Thread(target=send_in_flight)
+    sender.start()
+    in_flight_started.wait(1)
+
+    with pytest.raises(redis.ConnectionError):
+        breaker.call(down)
+    time.sleep(0.02)
+    tester = threading.Thread(target=breaker.call, args=(trial,))
+    tester.start()
+    trial_started.wait(1)
+
+    in_flight_done.set()
+    sender.join()
+    # only the trial clears its flag
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: "up")
+
+    trial_done.set()
+    tester.join()
+    assert not breaker.is_open
+
+
+def test_daily_falls_back_without_redis(db):
+    from app import crud
+    from app.redis_client import CircuitBreaker, ResilientRedis
+    from app.schemas.word import WordCreate
+
+    crud.word.create(db, obj=WordCreate(origin=f"daily{uuid4().hex}"))
+    # nothing listens on port 1
+    down = ResilientRedis(port=1, breaker=CircuitBreaker(failures=1, reset=60))
+
+    word = crud.word.get_word_daily(db, down)
+    assert word is not None
+    assert crud.word.get_word_daily(db, down).id == word.id
+
+
+def test_memory_cache(db):
+    import asyncio
+
+    from redis.exceptions import LockError
+
+    from app import crud
+    from app.cache import AsyncMemoryRedis, MemoryRedis, UnsupportedCommand
+    from app.schemas.word import WordCreate
+
+    cache = MemoryRedis()
+    cache.hset("h", mapping={"id": 1, "date": "20210101"})
+    assert cache.hgetall("h") == {b"id": b"1", b"date": b"20210101"}
+    assert cache.hincrby("h", "id", 2) == 3
+    cache.set("s", "v", px=50)
+    assert cache.get("s") == b"v" and cache.ttl("s") == 0
+    time.sleep(0.06)
+    assert cache.get("s") is None and cache.ttl("s") == -2
+    assert cache.setbit("bits", 9, 1) == 0 and cache.getbit("bits", 9) == 1
+    assert cache.pipeline().sadd("ids", 1, 2).srem("ids", 2).execute() == [2, 1]
+    assert cache.smembers("ids") == {b"1"}
+    with cache.lock("l", timeout=1):
+        with pytest.raises(LockError):
+            with cache.lock("l", blocking_timeout=0.01):
+                pass
+    with pytest.raises(UnsupportedCommand):
+        cache.lpush("queue", "task")
+
+    crud.word.create(db, obj=WordCreate(origin=f"daily{uuid4().hex}"))
+    word = crud.word.get_word_daily(db, cache)
+    assert word is not None
+    assert crud.word.get_word_daily(db, cache).id == word.id
+    # the async client shares the store
+    async_word = asyncio.run(crud.word.get_word_daily_async(db, AsyncMemoryRedis(cache)))
+    assert async_word.id == word.id
+
+
+def test_write_batcher(db):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from sqlalchemy.exc import IntegrityError
+
+    from app.crud.batch import WriteBatcher
+    from app.database import engine
+    from app.models.word import Word
+
+    batcher = WriteBatcher(engine, window=0.2, max_size=5)
+    origins = [f"batch{uuid4().hex}" for _ in range(5)]
+    # a duplicate breaks the unique origin, the insert of one of the two fails
+    origins.append(origins[0])
+    with ThreadPoolExecutor(len(origins)) as executor:
+        futures = [
+            executor.submit(batcher.insert, Word, {"origin": origin}) for origin in origins
+        ]
+    failed = [future for future in futures if future.exception() is not None]
+    assert len(failed) == 1
+    assert failed[0] in (futures[0], futures[-1])
+    with pytest.raises(IntegrityError):
+        failed[0].result()
+    ids = [future.result() for future in futures if future is not failed[0]]
+    assert len(set(ids)) == 5
+    assert {word.origin for word in db.query(Word).filter(Word.id.in_(ids))} == set(origins)
+
+
+def test_admission_limiter():
+    import asyncio
+
+    from app.admission import Limiter, route_group
+
+    assert route_group(f"{settings.API_V1_STR}/login") == "auth"
+    assert route_group(f"{settings.API_V1_STR}/psychologies/12") == "content"
+    assert route_group(f"{settings.API_V1_STR}/psychologies/daily") is None
+    assert route_group(f"{settings.API_V1_STR}/today") is None
+
+    async def run():
+        limiter = Limiter(limit=1, queue_timeout=0.05)
+        assert await limiter.acquire()
+        # past its queue deadline
+        assert not await limiter.acquire()
+
+        # the slot passes to the one in line
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0.01)
+        assert limiter.queued == 1
+        limiter.release()
+        assert await waiting
+        assert limiter.running == 1 and limiter.queued == 0
+        limiter.release()
+        assert limiter.running == 0
+
+    asyncio.run(run())
+
+
+def test_rate_limiter(monkeypatch):
+    from app.cache import MemoryRedis
+    from app.ratelimit import RateLimiter
+
+    monkeypatch.setitem(settings.RATE_LIMITS, "test", {"requests": 20, "seconds": 10})
+    # the memory cache has no scripts, buckets are kept in this process
+    limiter = RateLimiter(MemoryRedis())
+    assert all(limiter.hit("test", "ip:1") == 0 for _ in range(20))
+    # refilled 2 per second
+    assert 0 < limiter.hit("test", "ip:1") <= 0.5
+    assert limiter.hit("test", "ip:2") == 0
+    time.sleep(0.5)
+    assert limiter.hit("test", "ip:1") == 0
+
+
+def test_rate_limiter_leases(monkeypatch):
+    from app.cache import MemoryRedis
+    from app.ratelimit import RATE_LIMIT_KEY, RateLimiter, lease_size
+
+    # no more than refilled while the lease lasts
+    monkeypatch.setattr(settings, "RATE_LIMIT_LEASE_SECONDS", 1)
+    assert lease_size(120, 2) == 2
+    assert lease_size(10, 10 / 60) == 1
+
+    monkeypatch.setitem(settings.RATE_LIMITS, "test", {"requests": 20, "seconds": 10})
+    key = f"{RATE_LIMIT_KEY}:test:ip:1"
+    limiter = RateLimiter(MemoryRedis())
+
+    def take(*args):
+        # another thread stores its lease while this one takes from redis
+        limiter._leases[key] = [1, time.monotonic() + 1]
+        return 2, 0
+
+    monkeypatch.setattr(limiter, "_take", take)
+    limiter._leases[key] = [0, time.monotonic() + 1]
+    assert limiter.hit("test", "ip:1") == 0
+    assert limiter._leases[key][0] == 2
+
+
+@pytest.mark.skipif(
+    settings.CACHE_BACKEND == "memory", reason="the token bucket script needs redis"
+)
+def test_rate_limiter_redis_bucket(monkeypatch):
+    from app.database import RedisLocal
+    from app.ratelimit import RATE_LIMIT_KEY, RateLimiter
+
+    monkeypatch.setitem(settings.RATE_LIMITS, "test", {"requests": 20, "seconds": 10})
+    key = f"{RATE_LIMIT_KEY}:test:ip:1"
+    RedisLocal.delete(key)
+    limiter = RateLimiter(RedisLocal)
+
+    # leases of 2 tokens until the bucket is empty, then wait for the next one
+    assert [limiter._take(key, 20, 2, 2) for _ in range(10)] == [(2, 0)] * 10
+    taken, wait_ms = limiter._take(key, 20, 2, 2)
+    assert taken == 0
+    assert 450 < wait_ms <= 500
+
+    # a lease is spent locally, one script call for every 2 hits
+    RedisLocal.delete(key)
+    limiter = RateLimiter(RedisLocal)
+    calls = []
+    take = limiter._take
+
+    def counted_take(*args):
+        calls.append(args)
+        return take(*args)
+
+    monkeypatch.setattr(limiter, "_take", counted_take)
+    assert all(limiter.hit("test", "ip:1") == 0 for _ in range(20))
+    assert len(calls) == 10
+    assert limiter.hit("test", "ip:1") > 0
+
+
+def test_deadline_cancels_statement(db):
+    from sqlalchemy import text
+
+    from app.database import SessionLocal
+    from app.deadlines import DeadlineExceeded, set_deadline
+
+    slow = text(
+        "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 100000000)"
+        " SELECT count(*) FROM c"
+    )
+    session = SessionLocal()
+    set_deadline(session, time.monotonic() + 0.1)
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        session.execute(slow)
+    assert time.monotonic() - start < 1
+    session.close()
+
+    # the pooled connection has no deadline left
+    session = SessionLocal()
+    assert session.execute(text("SELECT 1")).scalar() == 1
+    session.close()
+
+
+def test_deadline_counts_from_arrival(monkeypatch):
+    from starlette.requests import Request
+
+    from app.deadlines import ARRIVAL_KEY, DEADLINE_HEADER, request_deadline
+
+    monkeypatch.setattr(settings, "REQUEST_TIMEOUT", 30)
+    monkeypatch.setattr(settings, "REQUEST_TIMEOUTS", {})
+    # waited 5 seconds in line before the endpoint
+    arrived = time.monotonic() - 5
+    scope = {
+        "type": "http",
+        "scheme": "http",
+        "server": ("testserver", 80),
+        "path": f"{settings.API_V1_STR}/words/",
+        "query_string": b"",
+        "headers": [],
+        ARRIVAL_KEY: arrived,
+    }
+    assert request_deadline(Request(scope)) == arrived + 30
+
+    scope["headers"] = [(DEADLINE_HEADER.lower().encode(), b"2")]
+    assert request_deadline(Request(scope)) < time.monotonic()
+
+
+def test_unseen_round_keeps_other_groups_seen(db):
+    from app import crud
+    from app.database import RedisLocal
+    from app.schemas.psychology import PsychologyClassifyEnum, PsychologyCreate
+
+    first, other = list(PsychologyClassifyEnum)[:2]
+    crud.psychology.create(db, obj=PsychologyCreate(knowledge="a", classify=first.value))
+    other_psy = crud.psychology.create(
+        db, obj=PsychologyCreate(knowledge="b", classify=other.value)
+    )
+    seen_key = f"psychology_seen:test{uuid4().hex}"
+    RedisLocal.setbit(seen_key, other_psy.id, 1)
+
+    # every psychology of the first classify, then a new round of it
+    for _ in range(crud.psychology.count_exact(db, classify=first.value) + 1):
+        assert crud.psychology.get_random_unseen(db, seen_key, classify=first.value)
+    assert RedisLocal.getbit(seen_key, other_psy.id) == 1
+    RedisLocal.delete(seen_key)
+
+
+def test_random_multi_skips_removed_ids(db):
+    from app import crud
+    from app.database import RedisLocal
+    from app.models.word import Word
+    from app.schemas.word import WordCreate
+
+    words = [
+        crud.word.create(db, obj=WordCreate(origin=f"pool{uuid4().hex}"))
+        for _ in range(3)
+    ]
+    crud.word.fill_pool(db)
+    # removed behind the pool
+    db.query(Word).filter(Word.id == words[0].id).delete()
+    db.commit()
+
+    # more than the rows, the removed id is sampled too
+    count = crud.word.count_exact(db)
+    db_objs = crud.word.get_random_multi(db, count + 1)
+    assert len({db_obj.id for db_obj in db_objs}) == count
+    assert str(words[0].id).encode() not in RedisLocal.smembers(crud.word.pool_key())
+
+
+def test_daily_lock_timeouts_keep_redis_row(db, monkeypatch):
+    import threading
+    from datetime import datetime
+
+    from app import crud
+    from app.cache import MemoryRedis
+    from app.crud import base
+    from app.schemas.word import WordCreate
+
+    today = datetime.strftime(datetime.now(), "%Y%m%d")
+    words = [
+        crud.word.create(db, obj=WordCreate(origin=f"lock{uuid4().hex}"))
+        for _ in range(2)
+    ]
+    monkeypatch.setattr(base, "DAILY_LOCK_TIMEOUT", 0.2)
+
+    # another worker holds the lock past our wait, and saves its pick meanwhile
+    cache = MemoryRedis()
+    lock = cache.lock("daily_test:lock", timeout=5)
+    lock.acquire()
+    threading.Timer(
+        0.1, cache.hset, ("daily_test",), {"mapping": {"id": words[0].id, "date": today}}
+    ).start()
+    word = crud.word.get_daily(db, cache, "daily_test", lambda: words[1])
+    assert word.id == words[0].id
+
+    # our pick outlives the lock, it is the row of the day anyway
+    cache = MemoryRedis()
+
+    def slow_pick():
+        time.sleep(0.3)
+        return words[1]
+
+    assert crud.word.get_daily(db, cache, "daily_test", slow_pick).id == words[1].id
+    assert cache.hget("daily_test", "id") == str(words[1].id).encode()
+
+
+def test_digest_resumes_and_retries_failed(db, monkeypatch):
+    from datetime import date
+
+    from app import digest
+    from app.database import RedisLocal
+    from app.models.user import User
+
+    users = [
+        User(email=f"digest{uuid4().hex}@example.com", hashed_password="-", is_confirm=True)
+        for _ in range(3)
+    ]
+    db.add_all(users)
+    db.commit()
+
+    progress_key = f"digest:{date.today():%Y%m%d}"
+    failed_key = f"{progress_key}:failed"
+    RedisLocal.delete(progress_key, failed_key)
+    # a stopped job sent up to users[0], but failed to reach it
+    RedisLocal.hset(progress_key, "last_id", users[0].id)
+    RedisLocal.sadd(failed_key, users[0].id)
+
+    sent_to = []
+    down = {users[1].email}
+
+    def send(self, email_to):
+        sent_to.append(email_to)
+        return email_to not in down
+
+    monkeypatch.setattr(settings, "EMAILS_ENABLED", True)
+    monkeypatch.setattr(digest, "render_digest", lambda db: "")
+    monkeypatch.setattr(digest.DigestSender, "send", send)
+
+    kwargs = dict(batch_size=2, concurrency=2, rate=0)
+    assert digest.send_digest(db, **kwargs) == (2, 1)
+    assert sent_to == [user.email for user in users]
+    assert RedisLocal.smembers(failed_key) == {str(users[1].id).encode()}
+    assert int(RedisLocal.hget(progress_key, "last_id")) == users[2].id
+
+    # the next run sends to the failed user alone
+    sent_to.clear()
+    down.clear()
+    assert digest.send_digest(db, **kwargs) == (1, 0)
+    assert sent_to == [users[1].email]
+    assert not RedisLocal.smembers(failed_key)
+
+
+def test_profile_samples_request_threads():
+    import asyncio
+    import threading
+
+    from starlette.concurrency import run_in_threadpool
+
+    from app.profiler import ProfiledExecutor, Sampler, _request_sampler
+
+    def spin(seconds):
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            pass
+
+    def endpoint():
+        spin(0.2)
+
+    async def request():
+        asyncio.get_running_loop().set_default_executor(ProfiledExecutor())
+        sampler = Sampler(0.005, request_thread=threading.get_ident())
+        _request_sampler.set(sampler)
+        sampler.start()
+        await run_in_threadpool(endpoint)
+        return sampler.stop()
+
+    # another request spinning meanwhile is not sampled
+    other = threading.Thread(target=spin, args=(0.3,), name="other")
+    other.start()
+    stacks = asyncio.run(request()).stacks
+    other.join()
+    assert any("test_utils:endpoint" in stack for stack in stacks)
+    assert not any(stack.startswith("other;") for stack in stacks)